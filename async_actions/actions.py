@@ -1,5 +1,7 @@
 from celery.app.task import Task
+from celery.canvas import Signature
 from django.shortcuts import render
+from django.utils.module_loading import import_string
 from .messages import add_task_message
 from .settings import ASYNC_ACTIONS_PROCESSOR_CLS
 from .utils import get_task_name
@@ -15,9 +17,22 @@ class BaseTaskAction:
 
     # TODO: Is there an elegant way to distinct action class params from
     # processor class params?
-    def __init__(self, sig=None, processor_cls=None, permissions=None, lock_mode=None):
+    def __init__(self, sig=None, processor_cls=None, permissions=None, lock_mode=None,
+                 objects_per_task=None, deduplicate=None):
         self._sig = sig
         self._processor_cls = processor_cls or self.PROCESSOR_CLS or ASYNC_ACTIONS_PROCESSOR_CLS
+        self._processor_kwargs = dict()
+        # Batches of objects per task need a batch processor.
+        if objects_per_task:
+            if isinstance(sig, tuple(Signature.TYPES.values())):
+                raise ValueError('Batches work with single signatures only.')
+            if not (processor_cls or self.PROCESSOR_CLS):
+                self._processor_cls = 'async_actions.processor.BatchProcessor'
+            self._processor_kwargs['objects_per_task'] = objects_per_task
+        if deduplicate is not None:
+            self._processor_kwargs['deduplicate'] = deduplicate
+        if isinstance(self._processor_cls, str):
+            self._processor_cls = import_string(self._processor_cls)
         self._lock_mode = lock_mode
         self._name = get_task_name(sig)
         self.short_description = get_task_verbose_name(sig)
@@ -37,7 +52,8 @@ class BaseTaskAction:
         :param _type_ request: _description_
         :param _type_ queryset: _description_
         """
-        processor = self._processor_cls(queryset, self._sig, runtime_data, self._lock_mode)
+        processor = self._processor_cls(
+            queryset, self._sig, runtime_data, self._lock_mode, **self._processor_kwargs)
         processor.run()
 
         for task_state in processor.task_states:
@@ -127,12 +143,24 @@ def as_action(*args, **options):
     :param list permissions: _description_
     :param list forms: _description_
     :param const lock_mode: _description_
+    :param int objects_per_task: send that many objects with a single message
+        using the :class:`~.processor.BatchProcessor`
+    :param bool deduplicate: skip objects with unfinished tasks of this action
+    :param int max_concurrency: maximal number of runs of the task at the same
+        time across all workers, see :attr:`~.tasks.ActionTask.max_concurrency`
     """
     def create_action_from_task(**options):
 
         def _inner(signature):
             if isinstance(signature, Task):
                 signature = signature.signature()
+            if 'max_concurrency' in options:
+                if isinstance(signature, tuple(signature.TYPES.values())):
+                    raise ValueError('Set max_concurrency on the tasks of a canvas.')
+                # Do not change the headers of a signature passed by the caller.
+                signature = signature.clone()
+                headers = signature.options.get('headers', {})
+                signature.set(headers={**headers, 'max_concurrency': options.pop('max_concurrency')})
             if 'verbose_name' in options:
                 signature.verbose_name = options.pop('verbose_name')
             if 'description' in options:
@@ -1,4 +1,6 @@
 from django.contrib import admin
+from django.template.loader import render_to_string
+from django.utils.translation import gettext_lazy as _
 from .models import ActionTaskState
 
 
@@ -10,6 +12,39 @@ class ActionTaskModelAdmin(admin.ModelAdmin):
         }
 
 
+class TaskStatusColumnMixin:
+    """
+    Mixin for an :class:`.ActionTaskModelAdmin` providing a task_status
+    column for the list_display. The column shows the latest task state of
+    each row. The task states of all rows of a changelist page are fetched
+    with a single query. The status of unfinished tasks is kept up to date
+    by the task monitoring javascript.
+    """
+
+    #: Only show task states of these tasks. None means all tasks.
+    task_status_task_names = None
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        if 'task_status' in changelist.list_display:
+            # Evaluating the result list populates its cache. So the rows
+            # rendered afterwards are the objects we annotate here.
+            objs = list(changelist.result_list)
+            task_states = ActionTaskState.objects.latest_states(objs, self.task_status_task_names)
+            task_states = {s.obj_id: s for s in task_states}
+            for obj in objs:
+                obj._task_state = task_states.get(obj.pk)
+        return changelist
+
+    def task_status(self, obj):
+        task_state = getattr(obj, '_task_state', None)
+        if task_state is None:
+            return self.get_empty_value_display()
+        context = dict(task_state=task_state)
+        return render_to_string('async_actions/task_status.html', context)
+    task_status.short_description = _('Task status')
+
+
 @admin.register(ActionTaskState)
 class ActionTaskResultAdmin(admin.ModelAdmin):
-    pass
\ No newline at end of file
+    pass
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AsyncActionsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'async_actions'
+
+    def ready(self):
+        from . import signals
@@ -1,7 +1,26 @@
+from django.db.models import F
 from django_celery_results.backends import DatabaseBackend
+from .events import touch_task
+from .models import ActionTaskState
 
 
 class ActionDatabaseBackend(DatabaseBackend):
     """
-    _summary_
+    Database result backend keeping the revisions of task states in sync. The
+    result backend updates the status via the parent model. So the revision
+    of a task state is incremented here, but only for tasks marked by the
+    processor as having a task state.
     """
+
+    def _has_task_state(self, request):
+        headers = getattr(request, 'headers', None) or {}
+        return 'task_state' in headers or 'batch' in headers
+
+    def _store_result(self, task_id, result, status, traceback=None, request=None, using=None):
+        result = super()._store_result(
+            task_id, result, status, traceback=traceback, request=request, using=using)
+        if self._has_task_state(request):
+            queryset = ActionTaskState.objects.filter(task_id=task_id)
+            if queryset.update(revision=F('revision') + 1):
+                touch_task(task_id)
+        return result
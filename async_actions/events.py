@@ -0,0 +1,38 @@
+from uuid import uuid4
+from django.core.cache import caches
+from .settings import ASYNC_ACTIONS_EVENTS_CACHE
+
+
+#: Prefix for the cache keys of task versions.
+KEY_PREFIX = 'async_actions_task'
+
+#: Seconds a task version is kept in the cache.
+TIMEOUT = 60 * 60 * 24
+
+
+def _get_key(task_id):
+    return f'{KEY_PREFIX}:{task_id}'
+
+
+def touch_task(*task_ids):
+    r"""
+    Mark tasks as changed by setting a new version in the cache. Called on
+    state transitions and new notes.
+
+    :param list \*task_ids: ids of changed tasks
+    """
+    cache = caches[ASYNC_ACTIONS_EVENTS_CACHE]
+    cache.set_many({_get_key(i): uuid4().hex for i in task_ids}, TIMEOUT)
+
+
+def get_task_versions(task_ids):
+    """
+    Get the current versions of tasks. Tasks without version are missing in
+    the returned dictionary.
+
+    :param list task_ids: ids of tasks
+    :return dict: task ids mapped to their versions
+    """
+    cache = caches[ASYNC_ACTIONS_EVENTS_CACHE]
+    versions = cache.get_many([_get_key(i) for i in task_ids])
+    return {k[len(KEY_PREFIX) + 1:]: v for k, v in versions.items()}
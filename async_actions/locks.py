@@ -0,0 +1,270 @@
+import hashlib
+import random
+from functools import lru_cache
+from celery import signature
+from django.core.cache import caches
+from django.db import connections
+from django.db import router
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .exceptions import OccupiedLockException
+from .models import Lock
+from .models import LockWaiter
+from .settings import ASYNC_ACTIONS_LOCK_BACKEND
+from .settings import ASYNC_ACTIONS_LOCK_CACHE
+
+
+class BaseLockBackend:
+    """
+    Base class for lock backends. A lock backend gets all locks or none of
+    them and releases locks. Locks could be leased for a limited time.
+    """
+
+    #: Whether locks could be acquired and released by different workers as
+    #: done with :attr:`~.processor.Processor.OUTER_LOCK`.
+    supports_outer_lock = True
+
+    def get_locks(self, *lock_ids, owner=None, timeout=None):
+        r"""
+        Get all locks or raise an :class:`~.exceptions.OccupiedLockException`.
+
+        :param list \*lock_ids: ids of locks to be acquired
+        :param str owner: owner of the locks
+        :param int timeout: lease time in seconds, defaults to no expiry
+        """
+        raise NotImplementedError
+
+    def get_any_lock(self, *lock_ids, owner=None, timeout=None):
+        r"""
+        Get one of the given locks. The locks are tried in random order to
+        spread concurrent callers.
+
+        :param list \*lock_ids: ids of locks to choose from
+        :param str owner: owner of the lock
+        :param int timeout: lease time in seconds, defaults to no expiry
+        :return str: id of the acquired lock or None if all are occupied
+        """
+        lock_ids = list(lock_ids)
+        random.shuffle(lock_ids)
+        for lock_id in lock_ids:
+            try:
+                self.get_locks(lock_id, owner=owner, timeout=timeout)
+            except OccupiedLockException:
+                continue
+            return lock_id
+        return None
+
+    def extend_locks(self, *lock_ids, owner=None, timeout=None):
+        r"""
+        Extend the lease of locks.
+
+        :param list \*lock_ids: ids of locks to be extended
+        :param str owner: owner of the locks
+        :param int timeout: new lease time in seconds counted from now
+        """
+
+    def release_locks(self, *lock_ids, owner=None):
+        r"""
+        Release locks. If an owner is given only the locks of this owner are
+        released.
+
+        :param list \*lock_ids: ids of locks to be released
+        :param str owner: owner of the locks
+        """
+        raise NotImplementedError
+
+    def release_expired_locks(self):
+        """
+        Release all expired locks.
+
+        :return int: number of released locks
+        """
+        return 0
+
+
+class DatabaseLockBackend(BaseLockBackend):
+    """
+    Lock backend using the :class:`~.models.Lock` table. This is the default
+    and the only backend working with all databases and lock modes.
+    """
+
+    def get_locks(self, *lock_ids, owner=None, timeout=None):
+        return Lock.objects.get_locks(*lock_ids, owner=owner, timeout=timeout)
+
+    def get_any_lock(self, *lock_ids, owner=None, timeout=None):
+        # Only try the locks that are free or expired.
+        occupied = Lock.objects.filter(checksum__in=lock_ids).filter(
+            Q(expires__isnull=True) | Q(expires__gte=timezone.now()))
+        occupied = set(occupied.values_list('checksum', flat=True))
+        free = [i for i in lock_ids if i not in occupied]
+        return super().get_any_lock(*free, owner=owner, timeout=timeout)
+
+    def extend_locks(self, *lock_ids, owner=None, timeout=None):
+        return Lock.objects.extend_locks(*lock_ids, owner=owner, timeout=timeout)
+
+    def release_locks(self, *lock_ids, owner=None):
+        Lock.objects.release_locks(*lock_ids, owner=owner)
+
+    def release_expired_locks(self):
+        return Lock.objects.release_expired_locks()
+
+
+class AdvisoryLockBackend(BaseLockBackend):
+    """
+    Lock backend using PostgreSQL's session level advisory locks. No rows are
+    written to get or release a lock.
+
+    Advisory locks belong to a database session. So they could only be
+    released by the same database connection that acquired them. That's why
+    this backend works with :attr:`~.processor.Processor.INNER_LOCK` only.
+    A processor using :attr:`~.processor.Processor.OUTER_LOCK` with this
+    backend raises :class:`~django.core.exceptions.ImproperlyConfigured`.
+    For the same reason there is no need for a lease time. The locks of a
+    dead worker are released by the database when its session ends.
+    """
+
+    supports_outer_lock = False
+
+    def _get_connection(self):
+        return connections[router.db_for_write(Lock)]
+
+    def _get_keys(self, lock_ids):
+        """
+        Advisory locks are identified by a 64 bit integer. So we derive one
+        from each lock id.
+        """
+        keys = dict()
+        for lock_id in lock_ids:
+            digest = hashlib.blake2b(str(lock_id).encode(), digest_size=8).digest()
+            keys[int.from_bytes(digest, 'big', signed=True)] = lock_id
+        return keys
+
+    def get_locks(self, *lock_ids, owner=None, timeout=None):
+        keys = self._get_keys(lock_ids)
+        with self._get_connection().cursor() as cursor:
+            cursor.execute(
+                'SELECT key, pg_try_advisory_lock(key) FROM unnest(%s::bigint[]) AS key',
+                [sorted(keys)])
+            rows = cursor.fetchall()
+            acquired = [key for key, success in rows if success]
+            occupied = [key for key, success in rows if not success]
+            if occupied:
+                cursor.execute(
+                    'SELECT pg_advisory_unlock(key) FROM unnest(%s::bigint[]) AS key',
+                    [acquired])
+                raise OccupiedLockException(keys[occupied[0]])
+        return sorted(keys)
+
+    def release_locks(self, *lock_ids, owner=None):
+        # An advisory lock could only be released by the session holding it.
+        keys = self._get_keys(lock_ids)
+        with self._get_connection().cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_unlock(key) FROM unnest(%s::bigint[]) AS key',
+                [sorted(keys)])
+
+
+class CacheLockBackend(BaseLockBackend):
+    """
+    Lock backend using the atomic add operation of django's cache framework.
+    The cache must be shared by all workers, e.g. a memcached or redis cache.
+    The cache is configured by the ASYNC_ACTIONS_LOCK_CACHE setting. The lease
+    time of a lock is handled by the timeout of its cache entry.
+    """
+
+    #: Prefix for the cache keys of our locks.
+    key_prefix = 'async_actions_lock'
+
+    def _get_cache(self):
+        return caches[ASYNC_ACTIONS_LOCK_CACHE]
+
+    def _get_key(self, lock_id):
+        return f'{self.key_prefix}:{lock_id}'
+
+    def get_locks(self, *lock_ids, owner=None, timeout=None):
+        cache = self._get_cache()
+        acquired = list()
+        for lock_id in sorted(set(lock_ids)):
+            key = self._get_key(lock_id)
+            if cache.add(key, owner or lock_id, timeout=timeout):
+                acquired.append(key)
+            else:
+                cache.delete_many(acquired)
+                raise OccupiedLockException(lock_id)
+        return acquired
+
+    def extend_locks(self, *lock_ids, owner=None, timeout=None):
+        cache = self._get_cache()
+        for lock_id in lock_ids:
+            key = self._get_key(lock_id)
+            if timeout and (not owner or cache.get(key) == owner):
+                cache.touch(key, timeout)
+
+    def release_locks(self, *lock_ids, owner=None):
+        cache = self._get_cache()
+        keys = [self._get_key(i) for i in lock_ids]
+        if owner:
+            # Compare and delete. Leave the locks taken over by others alone.
+            keys = [k for k, v in cache.get_many(keys).items() if v == owner]
+        cache.delete_many(keys)
+
+
+@lru_cache(maxsize=None)
+def get_lock_backend():
+    """
+    Get an instance of the lock backend configured by the
+    ASYNC_ACTIONS_LOCK_BACKEND setting.
+
+    :return :class:`~.BaseLockBackend`: lock backend
+    """
+    backend_cls = ASYNC_ACTIONS_LOCK_BACKEND
+    if isinstance(backend_cls, str):
+        backend_cls = import_string(backend_cls)
+    return backend_cls()
+
+
+def get_slot_ids(name, size):
+    """
+    Get the lock ids of the slots of a counting semaphore. Holding one of the
+    locks means holding a slot.
+
+    :param str name: name of the semaphore, e.g. a task name
+    :param int size: number of slots
+    :return list: lock ids
+    """
+    return [hashlib.shake_128(f'{name}:slot:{i}'.encode()).hexdigest(12) for i in range(size)]
+
+
+def acquire_slot(name, size, owner=None, timeout=None):
+    """
+    Acquire a slot of a counting semaphore shared by all workers. The slots
+    are locks of the configured lock backend, so they are leased the same
+    way as other locks.
+
+    :param str name: name of the semaphore, e.g. a task name
+    :param int size: number of slots
+    :param str owner: owner of the slot
+    :param int timeout: lease time in seconds, defaults to no expiry
+    :return str: lock id of the slot or None if all slots are occupied
+    """
+    return get_lock_backend().get_any_lock(
+        *get_slot_ids(name, size), owner=owner, timeout=timeout)
+
+
+def wake_waiters(*lock_ids):
+    r"""
+    Re-send the first task waiting for each of the given locks. Since the
+    wait queue could be enabled per task this is done regardless of the
+    ASYNC_ACTIONS_LOCK_WAIT_QUEUE setting.
+
+    :param list \*lock_ids: ids of released locks
+    :return int: number of re-sent tasks
+    """
+    count = 0
+    for lock_id in lock_ids:
+        sig = LockWaiter.objects.pop_waiter(lock_id)
+        if sig:
+            signature(sig).apply_async()
+            count += 1
+    return count
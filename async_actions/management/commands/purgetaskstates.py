@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import time
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from ...retention import DEFAULT_POLICY
+from ...retention import purge_task_states
+
+
+class Command(BaseCommand):
+    help = (
+        'Purge finished task states, their notes and results in batches. By default '
+        'the retention policies of the ASYNC_ACTIONS_RETENTION setting are used.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--task-name', nargs='+', default=[],
+            help='Only purge these tasks using the --max-age and --max-count policy.')
+        parser.add_argument(
+            '--max-age', type=float,
+            help='Purge task states done more than that many days ago.')
+        parser.add_argument(
+            '--max-count', type=int,
+            help='Keep that many finished task states per task or of all tasks '
+                 'together without --task-name.')
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Number of task states deleted per batch.')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to sleep between batches to reduce the load.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the task states to purge.')
+
+    def get_policies(self, options):
+        if options['max_age'] is None and options['max_count'] is None:
+            if options['task_name']:
+                raise CommandError('--task-name needs --max-age or --max-count.')
+            return None
+        policy = dict(max_count=options['max_count'])
+        if options['max_age'] is not None:
+            policy['max_age'] = options['max_age'] * 86400
+        return {name: policy for name in options['task_name'] or [DEFAULT_POLICY]}
+
+    def handle(self, *args, **options):
+        def progress(task_name, deleted):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{task_name}: {deleted} task states deleted')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        counts = purge_task_states(
+            self.get_policies(options),
+            batch_size=options['batch_size'],
+            progress=progress,
+            dry_run=options['dry_run'],
+        )
+        verb = 'to purge' if options['dry_run'] else 'purged'
+        for task_name, count in counts.items():
+            self.stdout.write(f'{task_name}: {count} task states {verb}')
+        self.stdout.write(f'{sum(counts.values())} task states {verb} in total')
@@ -1,18 +1,42 @@
 from celery import states
+from django.core.cache import caches
 from django.template.loader import render_to_string
 from django.utils.html import mark_safe
 from item_messages import add_message
 from item_messages import update_message
 from item_messages import get_messages
 from item_messages import INFO, ERROR
-from .utils import get_task_message_checksum
+from .settings import ASYNC_ACTIONS_MESSAGE_CACHE
+from .settings import ASYNC_ACTIONS_MESSAGE_CACHE_TIMEOUT
 
 
-def build_task_message(task_state):
-    # Build message.
+def render_task_message(task_state):
+    """
+    Render the html of a task message. Rendered messages are cached per task
+    state revision in the cache named by ASYNC_ACTIONS_MESSAGE_CACHE. Eviction
+    is left to the cache backend, e.g. the LRU of the local memory cache
+    bounded by its MAX_ENTRIES option.
+
+    :param :class:`~.models.ActionTaskState` task_state: task state
+    :return str: rendered html
+    """
     template = 'async_actions/task_message.html'
     context = dict(task_state=task_state)
-    msg = render_to_string(template, context)
+    if not ASYNC_ACTIONS_MESSAGE_CACHE:
+        return render_to_string(template, context)
+
+    cache = caches[ASYNC_ACTIONS_MESSAGE_CACHE]
+    key = f'async_actions_msg:{task_state.task_id}:{task_state.revision}:{task_state.status}'
+    msg = cache.get(key)
+    if msg is None:
+        msg = render_to_string(template, context)
+        cache.set(key, msg, ASYNC_ACTIONS_MESSAGE_CACHE_TIMEOUT)
+    return msg
+
+
+def build_task_message(task_state):
+    # Build message.
+    msg = render_task_message(task_state)
 
     # Set level.
     if task_state.status in states.PROPAGATE_STATES:
@@ -23,7 +47,8 @@ def build_task_message(task_state):
     # Set processing status and extra data.
     extra_data = {
         'task_id': task_state.task_id,
-        'checksum': get_task_message_checksum(task_state),
+        'revision': task_state.revision,
+        'status': task_state.status,
     }
     return level, mark_safe(msg), task_state.status_tag, extra_data
 
@@ -34,4 +59,5 @@ def add_task_message(request, task_state):
 
 def update_task_message(request, msg_id, task_state):
     update_message(request, msg_id, *build_task_message(task_state))
-    return get_messages(request, msg_id=msg_id)
\ No newline at end of file
+    return get_messages(request, msg_id=msg_id)
+
@@ -0,0 +1,153 @@
+import re
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+from .settings import ASYNC_ACTIONS_METRICS_SINK
+from .settings import ASYNC_ACTIONS_STATSD_HOST
+from .settings import ASYNC_ACTIONS_STATSD_PORT
+from .settings import ASYNC_ACTIONS_STATSD_PREFIX
+
+
+#: Sent for each timed stage with the keyword arguments stage, seconds and
+#: labels. The sender is the processor class or :class:`~.tasks.ActionTask`.
+stage_timed = Signal()
+
+
+class BaseMetricsSink:
+    """
+    Base class for metrics sinks. A sink receives the durations of the
+    stages of :class:`~.processor.Processor` and :class:`~.tasks.ActionTask`.
+    """
+
+    def timing(self, stage, seconds, labels):
+        """
+        Record the duration of a stage.
+
+        :param str stage: name of the stage, e.g. processor.publish
+        :param float seconds: duration in seconds
+        :param dict labels: labels like the action or the task name
+        """
+        raise NotImplementedError
+
+
+class StatsdMetricsSink(BaseMetricsSink):
+    """
+    Send timings to a statsd daemon via udp. Labels are sent as tags in the
+    format understood by DogStatsD and Telegraf. The daemon is configured by
+    the ASYNC_ACTIONS_STATSD_HOST, ASYNC_ACTIONS_STATSD_PORT and
+    ASYNC_ACTIONS_STATSD_PREFIX settings.
+    """
+
+    def __init__(self):
+        self._address = (ASYNC_ACTIONS_STATSD_HOST, ASYNC_ACTIONS_STATSD_PORT)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _format(self, stage, seconds, labels):
+        metric = f'{ASYNC_ACTIONS_STATSD_PREFIX}.{stage}:{seconds * 1000:.3f}|ms'
+        if labels:
+            tags = [f'{k}:{self._escape(v)}' for k, v in labels.items()]
+            metric = f'{metric}|#{",".join(tags)}'
+        return metric
+
+    def _escape(self, value):
+        return re.sub(r'[^\w.-]', '_', str(value))
+
+    def timing(self, stage, seconds, labels):
+        try:
+            self._socket.sendto(self._format(stage, seconds, labels).encode(), self._address)
+        except OSError:
+            pass
+
+
+class PrometheusMetricsSink(BaseMetricsSink):
+    """
+    Collect timings as prometheus summaries within the current process. Use
+    :meth:`.render` to expose them in the prometheus text format, e.g. by a
+    view of your own.
+    """
+
+    #: Name of the prometheus metric.
+    metric = 'async_actions_stage_seconds'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self._sums = defaultdict(float)
+
+    def timing(self, stage, seconds, labels):
+        key = (('stage', stage),) + tuple(sorted(labels.items()))
+        with self._lock:
+            self._counts[key] += 1
+            self._sums[key] += seconds
+
+    def _escape(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        """
+        Render the collected timings in the prometheus text format.
+
+        :return str: prometheus metrics
+        """
+        lines = [f'# TYPE {self.metric} summary']
+        with self._lock:
+            for key, count in self._counts.items():
+                labels = ','.join(f'{k}="{self._escape(v)}"' for k, v in key)
+                lines.append(f'{self.metric}_count{{{labels}}} {count}')
+                lines.append(f'{self.metric}_sum{{{labels}}} {self._sums[key]}')
+        return '\n'.join(lines) + '\n'
+
+
+@lru_cache(maxsize=None)
+def get_metrics_sink():
+    """
+    Get an instance of the metrics sink configured by the
+    ASYNC_ACTIONS_METRICS_SINK setting.
+
+    :return :class:`~.BaseMetricsSink`: metrics sink or None
+    """
+    sink_cls = ASYNC_ACTIONS_METRICS_SINK
+    if not sink_cls:
+        return None
+    if isinstance(sink_cls, str):
+        sink_cls = import_string(sink_cls)
+    return sink_cls()
+
+
+def record(sender, stage, seconds, **labels):
+    r"""
+    Pass the duration of a stage to the metrics sink and send the
+    :data:`.stage_timed` signal.
+
+    :param sender: class of the timed object
+    :param str stage: name of the stage
+    :param float seconds: duration in seconds
+    :param dict \*\*labels: labels of the timing
+    """
+    sink = get_metrics_sink()
+    if sink:
+        sink.timing(stage, seconds, labels)
+    if stage_timed.has_listeners(sender):
+        stage_timed.send(sender, stage=stage, seconds=seconds, labels=labels)
+
+
+@contextmanager
+def timed(sender, stage, **labels):
+    r"""
+    Context manager recording the duration of its block. The duration is
+    recorded even if the block raises an exception.
+
+    :param sender: class of the timed object
+    :param str stage: name of the stage
+    :param dict \*\*labels: labels of the timing
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(sender, stage, time.perf_counter() - start, **labels)
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('async_actions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lock',
+            name='expires',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Expires'),
+        ),
+        migrations.AddField(
+            model_name='lock',
+            name='owner',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Owner'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('async_actions', '0002_lock_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LockWaiter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lock_id', models.CharField(db_index=True, max_length=24, verbose_name='Lock id')),
+                ('task_id', models.CharField(max_length=255, verbose_name='Task id')),
+                ('signature', models.TextField(verbose_name='Signature')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:02
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('async_actions', '0003_lockwaiter'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='actiontasknote',
+            options={'ordering': ('action_task', 'created_time', 'id'), 'verbose_name': 'Note', 'verbose_name_plural': 'Notes'},
+        ),
+    ]
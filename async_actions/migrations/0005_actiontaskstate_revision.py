@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('async_actions', '0004_actiontasknote_ordering'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='actiontaskstate',
+            name='revision',
+            field=models.PositiveIntegerField(default=0, help_text='Incremented on every status change and new note.', verbose_name='Revision'),
+        ),
+    ]
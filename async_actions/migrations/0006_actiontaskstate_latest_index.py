@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('async_actions', '0005_actiontaskstate_revision'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='actiontaskstate',
+            index=models.Index(fields=['ctype', 'obj_id', 'taskresult_ptr'], name='async_actio_ctype_i_5b8c8d_idx'),
+        ),
+    ]
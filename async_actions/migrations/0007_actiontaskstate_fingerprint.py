@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('async_actions', '0006_actiontaskstate_latest_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='actiontaskstate',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', help_text='Hash of the signature and the runtime data of the action.', max_length=32, verbose_name='Fingerprint'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:37
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('async_actions', '0007_actiontaskstate_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='actiontasknote',
+            name='created_time',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, help_text='The datetime this message were added.', verbose_name='Time of creation'),
+        ),
+    ]
@@ -1,12 +1,150 @@
+from collections import defaultdict
+from datetime import timedelta
 from celery import states
+from kombu.utils.json import dumps
+from kombu.utils.json import loads
 from django_celery_results.models import TaskResult
+from django_celery_results.managers import TaskResultManager
 from item_messages.constants import DEFAULT_TAGS
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db import IntegrityError
+from django.db import router
 from django.db import transaction
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from .exceptions import OccupiedLockException
+from .settings import ASYNC_ACTIONS_RUNTIME_WINDOW
+
+
+class ActionTaskStateManager(TaskResultManager):
+    """
+    Manager for :class:`~.ActionTaskState` supporting bulk creation.
+    """
+    @transaction.atomic
+    def bulk_create_states(self, task_states, batch_size=None):
+        """
+        Bulk create :class:`~.ActionTaskState` instances. Since django's
+        bulk_create does not work with multi-table inheritance we insert the
+        :class:`~django_celery_results.models.TaskResult` rows first and the
+        rows of our own table afterwards. Both using batched inserts.
+
+        :param list task_states: unsaved :class:`~.ActionTaskState` instances
+        :param int batch_size: maximal number of rows per insert statement
+        :return list: the saved :class:`~.ActionTaskState` instances
+        """
+        if not task_states:
+            return task_states
+        using = self._db or router.db_for_write(self.model)
+
+        # Insert the parent rows and copy back the values set by the database
+        # or by the fields pre_save method, e.g. date_created and the pk.
+        parent_fields = TaskResult._meta.concrete_fields
+        parents = list()
+        for task_state in task_states:
+            parent = TaskResult()
+            for field in parent_fields:
+                setattr(parent, field.attname, getattr(task_state, field.attname))
+            parents.append(parent)
+        TaskResult.objects.using(using).bulk_create(parents, batch_size=batch_size)
+
+        # Not all database backends return the primary keys of bulk inserted
+        # rows. In that case we need to fetch them separately.
+        if any(parent.pk is None for parent in parents):
+            task_ids = [parent.task_id for parent in parents]
+            pks = dict(TaskResult.objects.using(using).filter(
+                task_id__in=task_ids).values_list('task_id', 'pk'))
+            for parent in parents:
+                parent.pk = pks[parent.task_id]
+
+        for task_state, parent in zip(task_states, parents):
+            for field in parent_fields:
+                setattr(task_state, field.attname, getattr(parent, field.attname))
+            task_state.taskresult_ptr_id = parent.pk
+
+        # Now insert the rows of our own table.
+        fields = self.model._meta.local_concrete_fields
+        ops = connections[using].ops
+        max_batch_size = max(ops.bulk_batch_size(fields, task_states), 1)
+        batch_size = min(batch_size, max_batch_size) if batch_size else max_batch_size
+        for i in range(0, len(task_states), batch_size):
+            self._insert(task_states[i:i + batch_size], fields=fields, using=using)
+
+        for task_state in task_states:
+            task_state._state.adding = False
+            task_state._state.db = using
+        return task_states
+
+    def increment_revision(self, *pks):
+        r"""
+        Atomically increment the revision of task states.
+
+        :param list \*pks: primary keys of the task states
+        :return int: number of updated task states
+        """
+        return self.filter(pk__in=pks).update(revision=models.F('revision') + 1)
+
+    def get_runtimes(self, *task_names, window=None):
+        r"""
+        Get the average runtime of finished task states by task name. The
+        runtime is measured from the creation of a task state until the
+        task is done, so it includes the time the task was queued. Only task
+        states done within the window are taken into account. So the costs do
+        not grow with the task history.
+
+        :param list \*task_names: names of the tasks
+        :param int window: seconds back from now, defaults to the
+            ASYNC_ACTIONS_RUNTIME_WINDOW setting
+        :return dict: task names mapped to :class:`~datetime.timedelta` objects
+        """
+        window = window or ASYNC_ACTIONS_RUNTIME_WINDOW
+        runtime = models.ExpressionWrapper(
+            models.F('date_done') - models.F('date_created'),
+            output_field=models.DurationField())
+        queryset = self.filter(
+            task_name__in=task_names,
+            status__in=states.READY_STATES,
+            date_done__gte=timezone.now() - timedelta(seconds=window))
+        queryset = queryset.values('task_name').annotate(runtime=models.Avg(runtime))
+        return {r['task_name']: r['runtime'] for r in queryset.order_by()}
+
+    def latest_states(self, objs, task_names=None, per_task_name=False):
+        """
+        Get the latest task state of each object with a single query. Task
+        states are created in the order of their primary keys, so the latest
+        state is the one with the highest primary key. Uses DISTINCT ON where
+        supported and a subquery selecting the highest primary key per
+        partition otherwise.
+
+        :param objs: queryset or list of objects
+        :param list task_names: only consider states of these tasks
+        :param bool per_task_name: get the latest state per object and task
+        :return :class:`~django.db.models.query.QuerySet`: task states
+        """
+        # Unsliced querysets are passed as subquery.
+        if isinstance(objs, models.QuerySet) and objs.query.can_filter():
+            ctype = ContentType.objects.get_for_model(objs.model)
+            queryset = self.filter(ctype=ctype, obj_id__in=objs.values('pk'))
+        else:
+            obj_ids = defaultdict(list)
+            for obj in objs:
+                obj_ids[ContentType.objects.get_for_model(type(obj))].append(obj.pk)
+            if not obj_ids:
+                return self.none()
+            condition = models.Q()
+            for ctype, ids in obj_ids.items():
+                condition |= models.Q(ctype=ctype, obj_id__in=ids)
+            queryset = self.filter(condition)
+        if task_names is not None:
+            queryset = queryset.filter(task_name__in=task_names)
+
+        partition = ['ctype', 'obj_id', 'task_name'] if per_task_name else ['ctype', 'obj_id']
+        if connections[queryset.db].features.can_distinct_on_fields:
+            return queryset.order_by(*partition, '-pk').distinct(*partition)
+        latest = queryset.order_by().values(*partition).annotate(latest=models.Max('pk'))
+        return self.filter(pk__in=latest.values('latest'))
 
 
 class ActionTaskState(TaskResult):
@@ -18,6 +156,36 @@ class ActionTaskState(TaskResult):
     obj_id = models.PositiveIntegerField()
     obj = GenericForeignKey("ctype", "obj_id")
     verbose_name = models.CharField(max_length=128, verbose_name=_("Verbose task name"))
+    revision = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_("Revision"),
+        help_text=_("Incremented on every status change and new note."),
+    )
+    fingerprint = models.CharField(
+        max_length=32,
+        blank=True,
+        default='',
+        verbose_name=_("Fingerprint"),
+        help_text=_("Hash of the signature and the runtime data of the action."),
+    )
+
+    objects = ActionTaskStateManager()
+
+    def save(self, *args, **kwargs):
+        """
+        Save the task state. The revision is left out of updates and is
+        incremented atomically afterwards, so concurrent changes could not
+        get lost. The revision in memory is incremented as well.
+        """
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            update_fields = [f.name for f in self._meta.concrete_fields if not f.primary_key]
+        kwargs['update_fields'] = [f for f in update_fields if f != 'revision']
+        super().save(*args, **kwargs)
+        type(self).objects.increment_revision(self.pk)
+        self.revision += 1
 
     # TODO: Define a states module with appropriate constants to work with
     # status-tags.
@@ -34,6 +202,10 @@ class ActionTaskState(TaskResult):
         indexes = (
             models.Index(fields=["obj_id"]),
             models.Index(fields=["ctype"]),
+            # The date_created column belongs to the parent table. Since
+            # states are created in the order of their primary keys we use
+            # those for the latest state of an object.
+            models.Index(fields=["ctype", "obj_id", "taskresult_ptr"]),
         )
 
 
@@ -61,7 +233,8 @@ class ActionTaskNote(models.Model):
         help_text=_("ActionTask note"),
     )
     created_time = models.DateTimeField(
-        auto_now_add=True,
+        default=timezone.now,
+        editable=False,
         verbose_name=_("Time of creation"),
         help_text=_("The datetime this message were added."),
     )
@@ -71,7 +244,7 @@ class ActionTaskNote(models.Model):
         return DEFAULT_TAGS.get(int(self.level), "")
 
     class Meta:
-        ordering = ("action_task", "created_time")
+        ordering = ("action_task", "created_time", "id")
         verbose_name = _("Note")
         verbose_name_plural = _("Notes")
 
@@ -80,31 +253,83 @@ class LockManager(models.Manager):
     """
     _summary_
     """
-    @transaction.atomic
-    def get_locks(self, *lock_ids):
+    def _create_locks(self, locks, using):
+        try:
+            with transaction.atomic(using=using):
+                return self.using(using).bulk_create(locks)
+        except IntegrityError:
+            return None
+
+    def get_locks(self, *lock_ids, owner=None, timeout=None):
         r"""
-        _summary_
+        Get all locks or none of them. The locks are created with a single
+        insert statement in a deterministic order so that concurrent callers
+        with overlapping lock ids could not block each other alternately.
+        Expired locks are taken over.
 
-        :param list \*lock_ids: ids of locks to be released
-        :return _type_: _description_
-        """
-        locks = []
-        for lock_id in lock_ids:
-            lock, created = self.get_or_create(checksum=lock_id)
-            if not created:
-                raise OccupiedLockException(lock_id)
-            else:
-                locks.append(lock)
-        return locks
-
-    def release_locks(self, *lock_ids):
+        :param list \*lock_ids: ids of locks to be acquired
+        :param str owner: owner of the locks, e.g. task id and hostname
+        :param int timeout: lease time in seconds, defaults to no expiry
+        :raise :class:`~.exceptions.OccupiedLockException`: if a lock is occupied
+        :return list: list of :class:`~.models.Lock` instances
+        """
+        lock_ids = sorted(set(lock_ids))
+        expires = timezone.now() + timedelta(seconds=timeout) if timeout else None
+        locks = [self.model(checksum=i, owner=owner, expires=expires) for i in lock_ids]
+        using = self._db or router.db_for_write(self.model)
+
+        created = self._create_locks(locks, using)
+        if created is None:
+            # Remove expired locks and try once again.
+            queryset = self.using(using).filter(checksum__in=lock_ids)
+            if queryset.filter(expires__lt=timezone.now()).delete()[0]:
+                created = self._create_locks(locks, using)
+
+        if created is None:
+            occupied = self.using(using).filter(checksum__in=lock_ids)
+            lock_id = occupied.values_list('checksum', flat=True).first()
+            raise OccupiedLockException(lock_id or lock_ids[0])
+        return created
+
+    def extend_locks(self, *lock_ids, owner=None, timeout=None):
         r"""
-        Release locks by deleting their :class:`~.models.Lock` instances.
+        Extend the lease of locks. If an owner is given only the locks of this
+        owner are extended.
+
+        :param list \*lock_ids: ids of locks to be extended
+        :param str owner: owner of the locks
+        :param int timeout: new lease time in seconds counted from now
+        :return int: number of extended locks
+        """
+        if not timeout:
+            return 0
+        queryset = self.filter(checksum__in=lock_ids)
+        if owner:
+            queryset = queryset.filter(owner=owner)
+        return queryset.update(expires=timezone.now() + timedelta(seconds=timeout))
+
+    def release_locks(self, *lock_ids, owner=None):
+        r"""
+        Release locks by deleting their :class:`~.models.Lock` instances using
+        a single delete statement. If an owner is given only the locks of this
+        owner are released. So a task whose lease expired could not release
+        a lock that was taken over by another one.
 
         :param list \*lock_ids: ids of locks to be released
+        :param str owner: owner of the locks
+        """
+        queryset = self.filter(checksum__in=lock_ids)
+        if owner:
+            queryset = queryset.filter(owner=owner)
+        queryset.delete()
+
+    def release_expired_locks(self):
+        """
+        Release all expired locks using a single delete statement.
+
+        :return int: number of released locks
         """
-        for lock_id in lock_ids:
-            self.get(checksum=lock_id).delete()
+        return self.filter(expires__lt=timezone.now()).delete()[0]
 
 
 class Lock(models.Model):
@@ -115,4 +340,58 @@ class Lock(models.Model):
     more reliable alternative.
     """
     checksum = models.CharField('Checksum', max_length=24, unique=True)
+    owner = models.CharField('Owner', max_length=255, blank=True, null=True)
+    expires = models.DateTimeField('Expires', blank=True, null=True, db_index=True)
     objects = LockManager()
+
+
+class LockWaiterManager(models.Manager):
+    """
+    Manager for :class:`~.LockWaiter` implementing a simple fifo queue.
+    """
+    def add_waiter(self, lock_id, task_id, signature):
+        """
+        Register a task as waiter on a lock.
+
+        :param str lock_id: id of the occupied lock
+        :param str task_id: id of the waiting task
+        :param dict signature: signature to re-send the task with
+        :return :class:`~.LockWaiter`: the waiter
+        """
+        return self.create(lock_id=lock_id, task_id=task_id, signature=dumps(signature))
+
+    def remove_waiter(self, waiter):
+        """
+        Remove a waiter from the queue. Returns False if the waiter was already
+        removed by someone else.
+
+        :param :class:`~.LockWaiter` waiter: the waiter
+        :return bool: True if the waiter was removed
+        """
+        return bool(self.filter(pk=waiter.pk).delete()[0])
+
+    def pop_waiter(self, lock_id):
+        """
+        Remove the first waiter of a lock from the queue and return its
+        signature. Concurrent callers never get the same waiter.
+
+        :param str lock_id: id of the lock
+        :return dict: signature of the waiting task or None
+        """
+        while True:
+            waiter = self.filter(lock_id=lock_id).order_by('pk').first()
+            if waiter is None:
+                return None
+            elif self.remove_waiter(waiter):
+                return loads(waiter.signature)
+
+
+class LockWaiter(models.Model):
+    """
+    A task waiting for a lock to be released.
+    """
+    lock_id = models.CharField('Lock id', max_length=24, db_index=True)
+    task_id = models.CharField('Task id', max_length=255)
+    signature = models.TextField('Signature')
+    created = models.DateTimeField('Created', auto_now_add=True)
+    objects = LockWaiterManager()
@@ -0,0 +1,77 @@
+from celery import states
+from django.core.cache import caches
+from django.utils import timezone
+from .models import ActionTaskState
+from .settings import ASYNC_ACTIONS_EVENTS_CACHE
+from .settings import ASYNC_ACTIONS_POLL_MIN_DELAY
+from .settings import ASYNC_ACTIONS_POLL_MAX_DELAY
+
+
+#: Prefix for the cache keys of average task runtimes.
+KEY_PREFIX = 'async_actions_runtime'
+
+#: Seconds an average task runtime is cached.
+TIMEOUT = 60 * 5
+
+#: Fraction of the elapsed time of a task used as delay if its runtime is
+#: unknown or already exceeded.
+ELAPSED_FACTOR = 0.1
+
+
+def _get_key(task_name):
+    return f'{KEY_PREFIX}:{task_name}'
+
+
+def get_task_runtimes(task_names):
+    """
+    Get the average runtimes of tasks in seconds. The runtimes are cached for
+    :data:`TIMEOUT` seconds. Task names without finished task states are
+    missing in the returned dictionary.
+
+    :param list task_names: names of tasks
+    :return dict: task names mapped to their average runtime in seconds
+    """
+    cache = caches[ASYNC_ACTIONS_EVENTS_CACHE]
+    task_names = set(task_names)
+    cached = cache.get_many([_get_key(n) for n in task_names])
+    runtimes = {k[len(KEY_PREFIX) + 1:]: v for k, v in cached.items()}
+
+    missing = task_names - set(runtimes.keys())
+    if missing:
+        queried = ActionTaskState.objects.get_runtimes(*missing)
+        # Cache unknown runtimes as well to not query them on each poll.
+        queried = {n: queried[n].total_seconds() if n in queried else None for n in missing}
+        cache.set_many({_get_key(n): r for n, r in queried.items()}, TIMEOUT)
+        runtimes.update(queried)
+
+    return {n: r for n, r in runtimes.items() if r is not None}
+
+
+def get_poll_delay(tasks):
+    """
+    Recommend the seconds a client should wait before polling the given tasks
+    again. A task expected to be done soon is polled more often than one that
+    is known to run for hours. The expectation is based on the average
+    runtime of finished tasks with the same name. If it is unknown or
+    exceeded the delay grows with the time the task is already running.
+
+    :param list tasks: tuples of task name, status and date created
+    :return float: delay in seconds
+    """
+    tasks = [t for t in tasks if t[1] not in states.READY_STATES]
+    if not tasks:
+        return ASYNC_ACTIONS_POLL_MAX_DELAY
+
+    now = timezone.now()
+    runtimes = get_task_runtimes(t[0] for t in tasks)
+    delays = list()
+    for task_name, status, date_created in tasks:
+        elapsed = (now - date_created).total_seconds()
+        runtime = runtimes.get(task_name)
+        if runtime and elapsed < runtime:
+            delays.append((runtime - elapsed) / 2)
+        else:
+            delays.append(elapsed * ELAPSED_FACTOR)
+
+    delay = min(delays)
+    return min(max(delay, ASYNC_ACTIONS_POLL_MIN_DELAY), ASYNC_ACTIONS_POLL_MAX_DELAY)
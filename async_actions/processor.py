@@ -1,13 +1,71 @@
+import hashlib
+import itertools
+import math
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import celery
+from celery.utils import uuid
+from kombu.utils.json import dumps
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.utils import timezone
+from .locks import get_lock_backend
 from .models import ActionTaskState
+from .settings import ASYNC_ACTIONS_BATCH_SIZE
+from .settings import ASYNC_ACTIONS_CHUNK_SIZE
+from .settings import ASYNC_ACTIONS_DEDUPLICATE
+from .settings import ASYNC_ACTIONS_DEDUPLICATE_TIMEOUT
+from .settings import ASYNC_ACTIONS_MAX_TASK_STATES
+from .settings import ASYNC_ACTIONS_OBJECTS_PER_TASK
+from .settings import ASYNC_ACTIONS_PUBLISH_CONCURRENCY
+from .metrics import record
+from .metrics import timed
 from .utils import get_object_checksum
+from .utils import get_task_name
 from .utils import get_task_verbose_name
 from .tasks import get_locks
 from .tasks import release_locks
 from .tasks import release_locks_on_error
 
 
+#: Placeholder for the lock ids in compiled signature templates.
+LOCK_IDS = '__async_actions_lock_ids__'
+
+#: Placeholder for the lock owner in compiled signature templates.
+LOCK_OWNER = '__async_actions_lock_owner__'
+
+
+def _copy_template(value, lock_ids=None, owner=None):
+    """
+    Copy a signature or template as nested dictionaries and lists. Lists only
+    holding the :data:`.LOCK_IDS` placeholder are replaced by the lock ids and
+    the :data:`.LOCK_OWNER` placeholder by the owner. Other values are not
+    copied since signatures are built from json compatible data.
+
+    :param value: signature, template or a part of it
+    :param list lock_ids: lock ids replacing the placeholders, if None the
+        placeholders are kept
+    :param str owner: owner replacing the placeholders, if None the
+        placeholders are kept
+    :return: copy of the value
+    """
+    if isinstance(value, dict):
+        return {k: _copy_template(v, lock_ids, owner) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        if lock_ids is not None and len(value) == 1 and value[0] == LOCK_IDS:
+            return list(lock_ids)
+        return [_copy_template(v, lock_ids, owner) for v in value]
+    elif owner is not None and value == LOCK_OWNER:
+        return owner
+    else:
+        return value
+
+
 class Processor:
     """
         A processor builds a celery workflow for a specific
@@ -18,6 +76,7 @@ class Processor:
     :param _type_ runtime_data: _description_, defaults to None
     :param bool inner_lock: _description_, defaults to True
     :param bool outer_lock: _description_, defaults to False
+    :param bool deduplicate: overwrites :attr:`.DEDUPLICATE`
     """
 
     #: Task based locking used for single tasks.
@@ -29,15 +88,37 @@ class Processor:
     #: Disabled locking.
     NO_LOCK = 'nolock'
 
-    def __init__(self, queryset, sig, runtime_data=None, lock_mode=None):
+    #: Maximal number of task states inserted with a single statement.
+    BATCH_SIZE = ASYNC_ACTIONS_BATCH_SIZE
+
+    #: Skip objects having unfinished task states of the same signature and
+    #: runtime data. The existing task states are reported instead. The rows
+    #: of the objects are locked with SELECT ... FOR UPDATE until their task
+    #: states are saved, so concurrent submissions of the same objects are
+    #: serialized. On databases without row locks, e.g. SQLite, two
+    #: concurrent submissions could still both pass the check.
+    DEDUPLICATE = ASYNC_ACTIONS_DEDUPLICATE
+
+    #: Seconds after which unfinished task states are no longer considered
+    #: as in-flight, e.g. those of a chain whose first task failed.
+    DEDUPLICATE_TIMEOUT = ASYNC_ACTIONS_DEDUPLICATE_TIMEOUT
+
+    def __init__(self, queryset, sig, runtime_data=None, lock_mode=None, deduplicate=None):
         self._queryset = queryset
         self._sig = sig
         self._runtime_data = runtime_data or dict()
         self._lock_mode = lock_mode or self._get_lock_mode(sig)
+        if self._lock_mode == self.OUTER_LOCK and not get_lock_backend().supports_outer_lock:
+            raise ImproperlyConfigured(
+                f'{type(get_lock_backend()).__name__} does not support outer locks.')
         self._results = list()
         self._task_states = list()
         self._signatures = None
         self._workflow = None
+        self._labels = dict(action=get_task_name(sig))
+        self._template = None
+        self._fingerprint = None
+        self._deduplicate = self.DEDUPLICATE if deduplicate is None else deduplicate
 
     def _get_lock_mode(self, sig):
         if isinstance(sig, tuple(sig.TYPES.values())):
@@ -56,14 +137,14 @@ class Processor:
 
     def _get_task_state(self, obj, signature):
         """
-        Create :class:`~.models.TaskState` instance for a signature or for all
-        signatures of a :class:`~celery.canvas.chain`.
+        Build an unsaved :class:`~.models.ActionTaskState` instance for a
+        signature. The instances are saved in bulk by :meth:`._save_task_states`.
 
         :param obj: object to run the action task with
         :type obj: :class:`~django.db.models.Model`
         :param signature: signature or chain
         :type signature: :class:`~celery.canvas.Signature` or :class:`~celery.canvas.chain`
-        :return list of :class:`~.models.TaskState`: list of TaskState instances
+        :return :class:`~.models.ActionTaskState`: unsaved ActionTaskState instance
         """
         content_type = ContentType.objects.get_for_model(type(obj))
         params = dict(
@@ -72,40 +153,185 @@ class Processor:
             task_id=signature.id,
             task_name=signature.task,
             verbose_name=get_task_verbose_name(signature),
+            fingerprint=self.fingerprint if self._deduplicate else '',
             status=celery.states.PENDING
         )
-        task_state = ActionTaskState(**params)
-        task_state.save()
-        return task_state
+        return ActionTaskState(**params)
 
-    def _get_signature(self, obj):
+    @property
+    def fingerprint(self):
         """
-        _summary_
+        Hash of the signature and the runtime data. All task states created by
+        the processor are marked with it.
+        """
+        if self._fingerprint is None:
+            sig = celery.signature(_copy_template(self._sig), app=self._sig._app)
+            if self._runtime_data:
+                self._add_runtime_data(sig)
+            data = dumps(sig, sort_keys=True).encode()
+            self._fingerprint = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return self._fingerprint
 
-        :return _type_: _description_
+    def _get_inflight_states(self, objs):
         """
-        # Clone original signature and add runtime data as kwargs.
-        # FIXME: sig.clone(kwargs=self._runtime_data) does not work for chained
-        # tasks. See: https://github.com/celery/celery/issues/5193.
-        sig = self._sig.clone(kwargs=self._runtime_data)
+        Get the unfinished task states of the objects having the processor's
+        fingerprint. The objects are queried in batches of :attr:`.BATCH_SIZE`
+        to stay within the variable limit of the database.
+
+        :param list objs: objects to run the action task with
+        :return dict: object ids mapped to lists of task states
+        """
+        ctype = ContentType.objects.get_for_model(self._queryset.model)
+        queryset = ActionTaskState.objects.filter(
+            ctype=ctype,
+            fingerprint=self.fingerprint,
+            status__in=celery.states.UNREADY_STATES,
+        )
+        if self.DEDUPLICATE_TIMEOUT:
+            since = timezone.now() - timedelta(seconds=self.DEDUPLICATE_TIMEOUT)
+            queryset = queryset.filter(date_created__gte=since)
+        task_states = dict()
+        for i in range(0, len(objs), self.BATCH_SIZE):
+            obj_ids = [obj.pk for obj in objs[i:i + self.BATCH_SIZE]]
+            for task_state in queryset.filter(obj_id__in=obj_ids).order_by('pk'):
+                task_states.setdefault(task_state.obj_id, list()).append(task_state)
+        return task_states
+
+    def _lock_objs(self, objs):
+        """
+        Lock the rows of the objects until the end of the transaction opened
+        by :meth:`._atomic`. The rows are locked in order of their primary
+        keys and in batches of :attr:`.BATCH_SIZE`.
+
+        :param list objs: objects to run the action task with
+        """
+        model = self._queryset.model
+        using = router.db_for_write(model)
+        if not connections[using].features.has_select_for_update:
+            return
+        queryset = model._base_manager.using(using).select_for_update().order_by('pk')
+        pks = sorted(obj.pk for obj in objs)
+        for i in range(0, len(pks), self.BATCH_SIZE):
+            list(queryset.filter(pk__in=pks[i:i + self.BATCH_SIZE]).values_list('pk', flat=True))
+
+    def _atomic(self):
+        """
+        With :attr:`.DEDUPLICATE` building the signatures and saving their
+        task states runs within a transaction holding the row locks of
+        :meth:`._lock_objs`.
+
+        :return: context manager
+        """
+        if not self._deduplicate:
+            return nullcontext()
+        return transaction.atomic(using=router.db_for_write(self._queryset.model))
+
+    def _fetch_objs(self, objs):
+        """
+        Fetch the objects. With :attr:`.DEDUPLICATE` objects having in-flight
+        task states are left out and their task states are returned instead.
+
+        :param objs: iterable of objects to run the action task with
+        :return tuple: list of objects and list of existing task states
+        """
+        with timed(type(self), 'processor.fetch', **self._labels):
+            objs = list(objs)
+        if not self._deduplicate or not objs:
+            return objs, list()
+        with timed(type(self), 'processor.deduplicate', **self._labels):
+            self._lock_objs(objs)
+            inflight = self._get_inflight_states(objs)
+        objs = [obj for obj in objs if obj.pk not in inflight]
+        existing = [t for task_states in inflight.values() for t in task_states]
+        return objs, existing
+
+    def _add_runtime_data(self, sig):
+        """
+        Add the runtime data as kwargs to all mutable signatures of a canvas.
+        Using sig.clone(kwargs=self._runtime_data) does not work for canvas.
+        See: https://github.com/celery/celery/issues/5193.
+
+        :param sig: signature or canvas
+        """
+        if isinstance(sig, (sig.TYPES['chain'], sig.TYPES['group'])):
+            for task in sig.tasks:
+                self._add_runtime_data(task)
+        elif isinstance(sig, sig.TYPES['chord']):
+            # The header of an unfrozen chord is a list of signatures.
+            header = sig.tasks
+            for task in header.tasks if isinstance(header, sig.TYPES['group']) else header:
+                self._add_runtime_data(task)
+            self._add_runtime_data(sig.body)
+        elif not sig.immutable:
+            sig.kwargs.update(self._runtime_data)
+
+    def _mark_task_states(self, sig):
+        """
+        Mark the signatures getting a task state by a task_state header. So
+        the result backend knows which results belong to a task state.
+
+        :param sig: signature or canvas
+        """
+        if isinstance(sig, (sig.TYPES['chain'], sig.TYPES['group'])):
+            for task in sig.tasks:
+                self._mark_task_states(task)
+        elif isinstance(sig, sig.TYPES['chord']):
+            header = sig.tasks
+            for task in header.tasks if isinstance(header, sig.TYPES['group']) else header:
+                self._mark_task_states(task)
+            self._mark_task_states(sig.body)
+        else:
+            sig.set(headers={**sig.options.get('headers', {}), 'task_state': True})
+
+    def _compile_template(self):
+        """
+        Compile the signature into a template which is stamped out for each
+        object by :meth:`._get_signature`. The signature, the runtime data and
+        the lock tasks are put together once. Lock ids are represented by
+        :data:`.LOCK_IDS` placeholders.
+
+        :return dict: signature as nested dictionaries and lists
+        """
+        placeholder = [LOCK_IDS]
+        sig = celery.signature(_copy_template(self._sig), app=self._sig._app)
+        if self._runtime_data:
+            self._add_runtime_data(sig)
+        self._mark_task_states(sig)
 
         # Pass the lock ids as headers and let the task handle the locks.
         if self._lock_mode == self.INNER_LOCK:
-            lock_ids = self._get_lock_ids(obj)
-            sig = sig.clone(headers={'lock_ids': lock_ids})
+            sig.set(headers={**sig.options.get('headers', {}), 'lock_ids': placeholder})
 
         # Chain get_locks, the signature and the release_locks task and add a
-        # link_error to handle locks when the sig raises an exception.
+        # link_error to handle locks when the sig raises an exception. The
+        # lock tasks of a chain share an owner, so a chain whose locks expired
+        # and were taken over does not release the locks of another chain.
         # FIXME: When the group part of a chord fails we got some weird errors.
         # This is a general problem with chords nested in a chain. It's not
         # the error callback.
         elif self._lock_mode == self.OUTER_LOCK:
-            lock_ids = self._get_lock_ids(obj)
             sig.set_immutable(True)
-            sig = get_locks.si(*lock_ids) | sig | release_locks.si(*lock_ids)
-            sig.set(link_error=release_locks_on_error.s(*lock_ids))
+            lock_sig = get_locks.si(*placeholder).set(headers=dict(lock_owner=LOCK_OWNER))
+            sig = lock_sig | sig | release_locks.si(*placeholder, owner=LOCK_OWNER)
+            sig.set(link_error=release_locks_on_error.s(*placeholder, owner=LOCK_OWNER))
 
-        return sig
+        return _copy_template(sig)
+
+    def _get_signature(self, obj):
+        """
+        Stamp out the signature for an object from the compiled template. This
+        is much cheaper than cloning the signature since celery deep copies
+        the options of each signature of a canvas.
+
+        :param obj: object to run the action task with
+        :type obj: :class:`~django.db.models.Model`
+        :return: signature or canvas
+        """
+        if self._template is None:
+            self._template = self._compile_template()
+        lock_ids = self._get_lock_ids(obj) if self._lock_mode != self.NO_LOCK else None
+        owner = uuid() if self._lock_mode == self.OUTER_LOCK else None
+        return celery.signature(_copy_template(self._template, lock_ids, owner), app=self._sig._app)
 
     def _get_task_states(self, obj, signature):
         """
@@ -128,23 +354,60 @@ class Processor:
             task_states.append(self._get_task_state(obj, signature))
         return task_states
 
-    def _get_signatures(self):
+    def _save_task_states(self, task_states):
         """
-        _summary_
+        Save the task states in batches of :attr:`.BATCH_SIZE`.
 
-        :return _type_: _description_
+        :param list task_states: unsaved :class:`~.models.ActionTaskState` instances
+        """
+        ActionTaskState.objects.bulk_create_states(task_states, self.BATCH_SIZE)
+
+    def _build_signatures(self, objs):
+        """
+        Build and freeze the signatures for the given objects and save their
+        task states.
+
+        :param objs: iterable of objects to run the action task with
+        :return tuple: list of signatures and list of task states including
+            the existing ones of skipped objects
         """
         signatures = list()
-        for obj in self._queryset:
+        task_states = list()
+        clone_time = freeze_time = collect_time = 0.0
+        objs, existing = self._fetch_objs(objs)
+
+        for obj in objs:
+            start = time.perf_counter()
             signature = self._get_signature(obj)
+            cloned = time.perf_counter()
             signature.freeze()
+            frozen = time.perf_counter()
             signatures.append(signature)
 
             # For primitives we loop over the tasks attribute of the
             # signature. Otherwise we simply use the signature in a
             # one-item-list.
-            self._task_states.extend(self._get_task_states(obj, signature))
+            task_states.extend(self._get_task_states(obj, signature))
+            clone_time += cloned - start
+            freeze_time += frozen - cloned
+            collect_time += time.perf_counter() - frozen
+
+        record(type(self), 'processor.clone', clone_time, **self._labels)
+        record(type(self), 'processor.freeze', freeze_time, **self._labels)
+        record(type(self), 'processor.collect_states', collect_time, **self._labels)
+        with timed(type(self), 'processor.save_states', **self._labels):
+            self._save_task_states(task_states)
+        return signatures, existing + task_states
+
+    def _get_signatures(self):
+        """
+        _summary_
 
+        :return _type_: _description_
+        """
+        with self._atomic():
+            signatures, task_states = self._build_signatures(self._queryset)
+        self._task_states.extend(task_states)
         return signatures
 
     def _get_workflow(self):
@@ -197,6 +460,15 @@ class Processor:
             self._workflow = self._get_workflow()
         return self._workflow
 
+    def _publish(self, workflow):
+        """
+        Send the messages of a workflow to the broker.
+
+        :param workflow: celery workflow
+        :return :class:`~celery.result.AsyncResult`: result object
+        """
+        return workflow.delay()
+
     def run(self):
         """
         Run the workflow build by :meth:`.get_workflow`. By default we do a
@@ -208,6 +480,222 @@ class Processor:
         # better chain support:
         # args = [self._runtime_data] if self._runtime_data else []
         # self._results = self.workflow.delay(*args)
-        self._results = self.workflow.delay()
-        self._results.save()
+        workflow = self.workflow
+        with timed(type(self), 'processor.publish', **self._labels):
+            self._results = self._publish(workflow)
+        with timed(type(self), 'processor.save_results', **self._labels):
+            self._results.save()
         return self._results
+
+
+class StreamingProcessor(Processor):
+    """
+    A processor for very large querysets. Instead of building one workflow
+    for all objects the queryset is iterated in chunks of :attr:`.CHUNK_SIZE`
+    objects. Each chunk is built, persisted and launched as its own
+    :class:`~celery.canvas.group`. So neither the objects nor the signatures
+    of the whole queryset are held in memory. Only the result objects of the
+    chunks are kept.
+
+    Since a session could not hold messages for an arbitrary number of tasks
+    only the first :attr:`.MAX_TASK_STATES` task states are kept.
+    """
+
+    #: Number of objects processed as one chunk.
+    CHUNK_SIZE = ASYNC_ACTIONS_CHUNK_SIZE
+
+    #: Maximal number of task states kept for the :attr:`.task_states`.
+    MAX_TASK_STATES = ASYNC_ACTIONS_MAX_TASK_STATES
+
+    def _get_chunks(self):
+        """
+        Iterate the queryset without caching and yield lists of objects.
+
+        :return generator: lists of at most :attr:`.CHUNK_SIZE` objects
+        """
+        objs = self._queryset.iterator(chunk_size=self.CHUNK_SIZE)
+        while True:
+            chunk = list(itertools.islice(objs, self.CHUNK_SIZE))
+            if not chunk:
+                break
+            yield chunk
+
+    def _get_chunk_workflow(self, signatures):
+        """
+        Build the workflow for a single chunk. By default we build a simple
+        :class:`~celery.canvas.group` of the chunk's signatures.
+
+        :param list signatures: signatures of a chunk
+        :return :class:`~celery.canvas.group`: celery workflow
+        """
+        return celery.group(*signatures)
+
+    def run(self):
+        """
+        Build and launch the workflow for each chunk of objects. Like
+        :meth:`.Processor.run` a saved :class:`~celery.result.GroupResult`
+        is returned. It holds the group results of the chunks.
+
+        :return :class:`~celery.result.GroupResult`: result object
+        """
+        results = list()
+        for chunk in self._get_chunks():
+            with self._atomic():
+                signatures, task_states = self._build_signatures(chunk)
+            workflow = self._get_chunk_workflow(signatures)
+            with timed(type(self), 'processor.publish', **self._labels):
+                results.append(self._publish(workflow))
+
+            space = max(self.MAX_TASK_STATES - len(self._task_states), 0)
+            self._task_states.extend(task_states[:space])
+
+        self._results = self._sig.app.GroupResult(uuid(), results)
+        with timed(type(self), 'processor.save_results', **self._labels):
+            self._results.save()
+        return self._results
+
+
+class ConcurrentPublishMixin:
+    """
+    Publish the tasks of a :class:`~celery.canvas.group` workflow in parallel.
+    Celery publishes the tasks of a group one after another using a single
+    producer. Instead we freeze the group and split its tasks into
+    :attr:`.CONCURRENCY` batches published by a thread pool. Each thread
+    acquires its own producer from the producer pool of the celery app, so
+    the broker_pool_limit should not be lower than the concurrency.
+
+    Other workflows and eager execution fall back to a simple delay call.
+    """
+
+    #: Number of threads publishing the tasks.
+    CONCURRENCY = ASYNC_ACTIONS_PUBLISH_CONCURRENCY
+
+    def _publish_batch(self, app, signatures):
+        """
+        Publish a batch of frozen signatures using a producer of the pool.
+
+        :param app: celery app
+        :param list signatures: frozen signatures
+        """
+        try:
+            with app.producer_or_acquire() as producer:
+                for signature in signatures:
+                    signature.apply_async(producer=producer, add_to_parent=False)
+        finally:
+            # Publishing a chord could use the database via the result
+            # backend. So we close the connections of the thread.
+            connections.close_all()
+
+    def _publish(self, workflow):
+        """
+        Publish the tasks of a group in parallel batches.
+
+        :param workflow: celery workflow
+        :return :class:`~celery.result.GroupResult`: result covering all tasks
+        """
+        app = workflow.app
+        if (self.CONCURRENCY < 2
+                or app.conf.task_always_eager
+                or not isinstance(workflow, workflow.TYPES['group'])
+                or not workflow.tasks):
+            return super()._publish(workflow)
+
+        # Freezing the group gives us the result of all its tasks. Like
+        # group.apply_async we pass the group id on to the tasks.
+        group_id = workflow.options.get('task_id') or uuid()
+        result = workflow.freeze(group_id=group_id)
+        tasks = list(workflow.tasks)
+        size = math.ceil(len(tasks) / self.CONCURRENCY)
+        batches = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            futures = [executor.submit(self._publish_batch, app, b) for b in batches]
+        for future in futures:
+            future.result()
+        return result
+
+
+class ConcurrentProcessor(ConcurrentPublishMixin, Processor):
+    """
+    A :class:`.Processor` publishing its tasks in parallel. See
+    :class:`.ConcurrentPublishMixin`.
+    """
+
+
+class ConcurrentStreamingProcessor(ConcurrentPublishMixin, StreamingProcessor):
+    """
+    A :class:`.StreamingProcessor` publishing the tasks of each chunk in
+    parallel. See :class:`.ConcurrentPublishMixin`.
+    """
+
+
+class BatchTaskMixin:
+    """
+    Send :attr:`.OBJECTS_PER_TASK` objects with a single message. The
+    :class:`~.tasks.ActionTask` runs once per object within a single
+    worker invocation. See :meth:`~.tasks.ActionTask.run_batch`. Each object
+    still gets its own :class:`~.models.ActionTaskState` and its own locks.
+
+    Batches work with single signatures only. Lock ids are passed per object
+    and handled by the task, so :attr:`.OUTER_LOCK` is not supported.
+
+    :param int objects_per_task: overwrites :attr:`.OBJECTS_PER_TASK`
+    """
+
+    #: Number of objects sent with a single message.
+    OBJECTS_PER_TASK = ASYNC_ACTIONS_OBJECTS_PER_TASK
+
+    def __init__(self, *args, objects_per_task=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if isinstance(self._sig, tuple(self._sig.TYPES.values())):
+            raise ValueError('Batches work with single signatures only.')
+        if self._lock_mode == self.OUTER_LOCK:
+            raise ValueError('Batches do not support outer locks.')
+        if objects_per_task:
+            self.OBJECTS_PER_TASK = objects_per_task
+
+    def _get_batch_signature(self, batch):
+        """
+        Build the signature for a batch of objects.
+
+        :param list batch: pairs of task ids and lock ids
+        :return :class:`~celery.canvas.Signature`: frozen signature
+        """
+        sig = self._sig.clone()
+        if self._runtime_data:
+            self._add_runtime_data(sig)
+        sig.set(headers={**sig.options.get('headers', {}), 'batch': batch})
+        sig.freeze()
+        return sig
+
+    def _build_signatures(self, objs):
+        signatures = list()
+        task_states = list()
+        objs, existing = self._fetch_objs(objs)
+
+        for i in range(0, len(objs), self.OBJECTS_PER_TASK):
+            batch = list()
+            for obj in objs[i:i + self.OBJECTS_PER_TASK]:
+                task_state = self._get_task_state(obj, self._sig)
+                task_state.task_id = uuid()
+                lock_ids = self._get_lock_ids(obj) if self._lock_mode != self.NO_LOCK else None
+                batch.append([task_state.task_id, lock_ids])
+                task_states.append(task_state)
+            signatures.append(self._get_batch_signature(batch))
+
+        with timed(type(self), 'processor.save_states', **self._labels):
+            self._save_task_states(task_states)
+        return signatures, existing + task_states
+
+
+class BatchProcessor(BatchTaskMixin, Processor):
+    """
+    A :class:`.Processor` sending many objects with a single message. See
+    :class:`.BatchTaskMixin`.
+    """
+
+
+class BatchStreamingProcessor(BatchTaskMixin, StreamingProcessor):
+    """
+    A :class:`.StreamingProcessor` sending many objects with a single
+    message. See :class:`.BatchTaskMixin`.
+    """
@@ -0,0 +1,125 @@
+from datetime import timedelta
+from celery import states
+from django.db import router
+from django.db import transaction
+from django.utils import timezone
+from .models import ActionTaskState
+from .settings import ASYNC_ACTIONS_PURGE_BATCH_SIZE
+from .settings import ASYNC_ACTIONS_RETENTION
+
+
+#: Key of the policy applied to all task names without a policy of their own.
+DEFAULT_POLICY = '*'
+
+
+def get_policies(policies=None):
+    """
+    Get the retention policies by task name. A policy is a dict with a
+    max_age given as :class:`~datetime.timedelta` or in seconds and a
+    max_count of finished task states to keep. The policy of the
+    :data:`.DEFAULT_POLICY` key applies to the task states of all other task
+    names together.
+
+    :param dict policies: policies, defaults to the ASYNC_ACTIONS_RETENTION setting
+    :return dict: policies with max_age as :class:`~datetime.timedelta`
+    """
+    policies = ASYNC_ACTIONS_RETENTION if policies is None else policies
+    normalized = dict()
+    for task_name, policy in policies.items():
+        max_age = policy.get('max_age')
+        if max_age is not None and not isinstance(max_age, timedelta):
+            max_age = timedelta(seconds=max_age)
+        normalized[task_name] = dict(max_age=max_age, max_count=policy.get('max_count'))
+    return normalized
+
+
+def get_purgeable(task_name, policy, exclude=()):
+    """
+    Get the finished task states of a task that are out of the retention
+    policy. The cutoff is computed up front so that the batches are selected
+    by the index on date_done. For the :data:`.DEFAULT_POLICY` the task
+    states of all task names but the excluded ones are selected.
+
+    :param str task_name: name of the task or :data:`.DEFAULT_POLICY`
+    :param dict policy: normalized retention policy
+    :param list exclude: task names with a policy of their own
+    :return :class:`~django.db.models.query.QuerySet`: task states or None
+    """
+    queryset = ActionTaskState.objects.filter(status__in=states.READY_STATES)
+    if task_name == DEFAULT_POLICY:
+        queryset = queryset.exclude(task_name__in=exclude)
+    else:
+        queryset = queryset.filter(task_name=task_name)
+    cutoffs = list()
+    if policy['max_age'] is not None:
+        cutoffs.append(timezone.now() - policy['max_age'])
+    if policy['max_count'] == 0:
+        cutoffs.append(timezone.now())
+    elif policy['max_count'] is not None:
+        # Keep all states done at the same time as the last one to keep.
+        dates = queryset.order_by('-date_done').values_list('date_done', flat=True)
+        cutoff = dates[policy['max_count'] - 1:policy['max_count']].first()
+        if cutoff is not None:
+            cutoffs.append(cutoff)
+    if not cutoffs:
+        return None
+    return queryset.filter(date_done__lt=max(cutoffs))
+
+
+def purge_queryset(queryset, batch_size=None, progress=None):
+    """
+    Delete task states with their notes and their
+    :class:`~django_celery_results.models.TaskResult` rows. The task states
+    are deleted in batches of primary keys, oldest states first. Each batch
+    is deleted within its own short transaction by a regular delete call, so
+    the cascade to the notes and the parent rows is handled by django.
+
+    :param queryset: :class:`~.models.ActionTaskState` queryset
+    :param int batch_size: number of task states per batch, defaults to the
+        ASYNC_ACTIONS_PURGE_BATCH_SIZE setting
+    :param callable progress: called with the number of deleted task states
+        after each batch
+    :return int: number of deleted task states
+    """
+    batch_size = batch_size or ASYNC_ACTIONS_PURGE_BATCH_SIZE
+    using = router.db_for_write(ActionTaskState)
+    pks = queryset.using(using).order_by('date_done').values_list('pk', flat=True)
+    deleted = 0
+    while True:
+        with transaction.atomic(using=using):
+            batch = list(pks[:batch_size])
+            if not batch:
+                break
+            ActionTaskState.objects.using(using).filter(pk__in=batch).delete()
+        deleted += len(batch)
+        if progress:
+            progress(deleted)
+    return deleted
+
+
+def purge_task_states(policies=None, batch_size=None, progress=None, dry_run=False):
+    """
+    Purge finished task states by their retention policies.
+
+    :param dict policies: policies, defaults to the ASYNC_ACTIONS_RETENTION setting
+    :param int batch_size: number of task states per batch
+    :param callable progress: called with the task name and the number of
+        deleted task states after each batch
+    :param bool dry_run: only count the task states to purge
+    :return dict: number of purged task states by task name or
+        :data:`.DEFAULT_POLICY`
+    """
+    policies = get_policies(policies)
+    task_names = [n for n in policies if n != DEFAULT_POLICY]
+
+    counts = dict()
+    for task_name, policy in policies.items():
+        queryset = get_purgeable(task_name, policy, task_names)
+        if queryset is None:
+            continue
+        elif dry_run:
+            counts[task_name] = queryset.count()
+        else:
+            callback = (lambda n, t=task_name: progress(t, n)) if progress else None
+            counts[task_name] = purge_queryset(queryset, batch_size, callback)
+    return counts
@@ -1,8 +1,105 @@
 # -*- coding: utf-8 -*-
 
 from django.conf import settings
-from .processor import Processor
 
 
-ASYNC_ACTIONS_PROCESSOR_CLS = getattr(settings, 'ASYNC_ACTIONS_PROCESSOR_CLS', Processor)
+#: The processor class could be given as class or as dotted path. Since our
+#: processor module depends on our models we avoid to import it here.
+ASYNC_ACTIONS_PROCESSOR_CLS = getattr(settings, 'ASYNC_ACTIONS_PROCESSOR_CLS', 'async_actions.processor.Processor')
 ASYNC_ACTION_DEBUG_MESSAGES = getattr(settings, 'ASYNC_ACTION_DEBUG_MESSAGES', False)
+
+#: Maximal number of rows inserted with a single statement by the processor.
+ASYNC_ACTIONS_BATCH_SIZE = getattr(settings, 'ASYNC_ACTIONS_BATCH_SIZE', 1000)
+
+#: Number of objects processed at once by the streaming processor.
+ASYNC_ACTIONS_CHUNK_SIZE = getattr(settings, 'ASYNC_ACTIONS_CHUNK_SIZE', 2000)
+
+#: Number of task states the streaming processor keeps for the messages of
+#: the admin.
+ASYNC_ACTIONS_MAX_TASK_STATES = getattr(settings, 'ASYNC_ACTIONS_MAX_TASK_STATES', 1000)
+
+#: Lock backend used by the action tasks. Given as class or as dotted path.
+ASYNC_ACTIONS_LOCK_BACKEND = getattr(settings, 'ASYNC_ACTIONS_LOCK_BACKEND', 'async_actions.locks.DatabaseLockBackend')
+
+#: Cache alias used by the :class:`~.locks.CacheLockBackend`.
+ASYNC_ACTIONS_LOCK_CACHE = getattr(settings, 'ASYNC_ACTIONS_LOCK_CACHE', 'default')
+
+#: Lease time of locks in seconds. None means locks never expire.
+ASYNC_ACTIONS_LOCK_TIMEOUT = getattr(settings, 'ASYNC_ACTIONS_LOCK_TIMEOUT', None)
+
+#: Let tasks wait for occupied locks in a queue instead of retrying them.
+ASYNC_ACTIONS_LOCK_WAIT_QUEUE = getattr(settings, 'ASYNC_ACTIONS_LOCK_WAIT_QUEUE', False)
+
+#: Number of notes buffered by an action task. 0 disables the buffer.
+ASYNC_ACTIONS_NOTE_BUFFER_SIZE = getattr(settings, 'ASYNC_ACTIONS_NOTE_BUFFER_SIZE', 0)
+
+#: Milliseconds after which buffered notes are written at the latest.
+ASYNC_ACTIONS_NOTE_BUFFER_TIME = getattr(settings, 'ASYNC_ACTIONS_NOTE_BUFFER_TIME', 1000)
+
+#: Cache alias used to signal task changes to streaming views. Should be a
+#: cache shared by workers and web processes.
+ASYNC_ACTIONS_EVENTS_CACHE = getattr(settings, 'ASYNC_ACTIONS_EVENTS_CACHE', 'default')
+
+#: Seconds a streaming or long polling request is held open at most.
+ASYNC_ACTIONS_STREAM_TIMEOUT = getattr(settings, 'ASYNC_ACTIONS_STREAM_TIMEOUT', 30)
+
+#: Seconds between two checks for changed tasks within a streaming request.
+ASYNC_ACTIONS_STREAM_INTERVAL = getattr(settings, 'ASYNC_ACTIONS_STREAM_INTERVAL', 0.5)
+
+#: Cache alias used for rendered task messages. None disables the cache.
+ASYNC_ACTIONS_MESSAGE_CACHE = getattr(settings, 'ASYNC_ACTIONS_MESSAGE_CACHE', 'default')
+
+#: Seconds a rendered task message is cached.
+ASYNC_ACTIONS_MESSAGE_CACHE_TIMEOUT = getattr(settings, 'ASYNC_ACTIONS_MESSAGE_CACHE_TIMEOUT', 300)
+
+#: Seconds a client should wait at least before polling task messages again.
+ASYNC_ACTIONS_POLL_MIN_DELAY = getattr(settings, 'ASYNC_ACTIONS_POLL_MIN_DELAY', 0.5)
+
+#: Seconds a client should wait at most before polling task messages again.
+ASYNC_ACTIONS_POLL_MAX_DELAY = getattr(settings, 'ASYNC_ACTIONS_POLL_MAX_DELAY', 30)
+
+#: Seconds back from now in which task states count for the average runtime
+#: of their task.
+ASYNC_ACTIONS_RUNTIME_WINDOW = getattr(settings, 'ASYNC_ACTIONS_RUNTIME_WINDOW', 60 * 60 * 24)
+
+#: Route the polling urls to the async views. Enable it when running under
+#: ASGI. Task messages are only streamed by the async views. The async views
+#: require django 4.1 and streaming requires django 4.2. With older versions
+#: the sync views are used.
+ASYNC_ACTIONS_ASGI = getattr(settings, 'ASYNC_ACTIONS_ASGI', False)
+
+#: Sink for the stage timings of processors and action tasks, e.g.
+#: 'async_actions.metrics.StatsdMetricsSink'. None disables the sink.
+ASYNC_ACTIONS_METRICS_SINK = getattr(settings, 'ASYNC_ACTIONS_METRICS_SINK', None)
+
+#: Address and metric prefix used by the :class:`~.metrics.StatsdMetricsSink`.
+ASYNC_ACTIONS_STATSD_HOST = getattr(settings, 'ASYNC_ACTIONS_STATSD_HOST', 'localhost')
+ASYNC_ACTIONS_STATSD_PORT = getattr(settings, 'ASYNC_ACTIONS_STATSD_PORT', 8125)
+ASYNC_ACTIONS_STATSD_PREFIX = getattr(settings, 'ASYNC_ACTIONS_STATSD_PREFIX', 'async_actions')
+
+#: Number of threads publishing tasks with the concurrent processors.
+ASYNC_ACTIONS_PUBLISH_CONCURRENCY = getattr(settings, 'ASYNC_ACTIONS_PUBLISH_CONCURRENCY', 4)
+
+#: Number of objects sent with a single message by the batch processors.
+ASYNC_ACTIONS_OBJECTS_PER_TASK = getattr(settings, 'ASYNC_ACTIONS_OBJECTS_PER_TASK', 100)
+
+#: Retention policies for finished task states by task name. Each policy is a
+#: dict with max_age (timedelta or seconds) and max_count. The policy of the
+#: '*' key applies to the task states of all other task names together.
+#: Nothing is purged by default.
+ASYNC_ACTIONS_RETENTION = getattr(settings, 'ASYNC_ACTIONS_RETENTION', dict())
+
+#: Number of task states deleted per batch and transaction when purging.
+ASYNC_ACTIONS_PURGE_BATCH_SIZE = getattr(settings, 'ASYNC_ACTIONS_PURGE_BATCH_SIZE', 1000)
+
+#: Skip objects having unfinished task states of the same action by default.
+ASYNC_ACTIONS_DEDUPLICATE = getattr(settings, 'ASYNC_ACTIONS_DEDUPLICATE', False)
+
+#: Seconds after which unfinished task states do not prevent new tasks.
+ASYNC_ACTIONS_DEDUPLICATE_TIMEOUT = getattr(settings, 'ASYNC_ACTIONS_DEDUPLICATE_TIMEOUT', 3600)
+
+#: Lease time in seconds of the concurrency slots of tasks with max_concurrency.
+ASYNC_ACTIONS_CONCURRENCY_TIMEOUT = getattr(settings, 'ASYNC_ACTIONS_CONCURRENCY_TIMEOUT', 600)
+
+#: Seconds tasks over their max_concurrency are deferred.
+ASYNC_ACTIONS_CONCURRENCY_RETRY_DELAY = getattr(settings, 'ASYNC_ACTIONS_CONCURRENCY_RETRY_DELAY', 10)
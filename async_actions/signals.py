@@ -0,0 +1,16 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from .events import touch_task
+from .models import ActionTaskState
+from .models import ActionTaskNote
+
+
+@receiver(post_save, sender=ActionTaskState)
+def task_state_saved(sender, instance, **kwargs):
+    touch_task(instance.task_id)
+
+
+@receiver(post_save, sender=ActionTaskNote)
+def task_note_saved(sender, instance, **kwargs):
+    ActionTaskState.objects.increment_revision(instance.action_task_id)
+    touch_task(instance.action_task.task_id)
@@ -1,24 +1,47 @@
 (function($) {
 
-    var interval = 800;
+    // Delays are given in seconds by the server. Polls without changes and
+    // failed runs double the delay up to max_backoff times. An update or a
+    // completed stream resets the backoff.
+    var delay = 0.8;
+    var backoff = 1;
+    var max_backoff = 16;
+    var max_delay = 300;
+    var timer = null;
+    var source = null;
     var error_msg = '[ERROR][task_by_ids]:';
     var baseurl = window.location.protocol + '//'
                 + window.location.host
-                + '/async_actions/messages/get/?';
+                + '/async_actions/messages/stream/?';
+    var pollurl = window.location.protocol + '//'
+                + window.location.host
+                + '/async_actions/messages/poll/';
+    var updateurl = window.location.protocol + '//'
+                  + window.location.host
+                  + '/async_actions/messages/get/?';
+
+    // Longer urls could be rejected by proxies. For those we fall back to
+    // batch polling.
+    var max_url_length = 2000;
 
     class TaskMessage {
         constructor(msg) {
             this.html = msg;
             this.msg_id = $(msg).attr('id');
-            this.checksum = $(msg).data('checksum');
+            this.revision = $(msg).data('revision');
         }
         update() {
             $('#' + this.msg_id).replaceWith(this.html);
-        }
-    }
 
-    function getTaskMessages (url) {
-        $.getJSON(url, updateTaskMessages).fail(ajaxFailure).done(run)
+            // Keep the status column of the task in sync.
+            var msg = $(this.html);
+            patchTaskStatus(msg.data('task_id'), {
+                status: msg.find('span.actiontask').attr('class').split(' ')[1],
+                status_tag: ['task-waiting', 'task-running', 'task-ready'].find(
+                    function(tag) { return msg.hasClass(tag); }),
+                revision: this.revision,
+            });
+        }
     }
 
     function updateTaskMessages(msgs) {
@@ -26,29 +49,196 @@
             var msg = new TaskMessage(msg_html);
             msg.update();
         })
+        if (!$.isEmptyObject(msgs)) {
+            backoff = 1;
+        }
+    }
+
+    // Apply the changes of a task returned by the batch polling endpoint to
+    // its message.
+    function patchTaskMessage(task_id, delta) {
+        if (delta.tags === undefined) {
+            return;
+        }
+        var msg = $('tr.item-message div[data-task_id="' + task_id + '"]');
+        var span = msg.find('span.actiontask');
+        var title = span.children('p');
+        var notes = span.find('ul.message-notes');
+        msg.attr('class', delta.tags);
+        msg.attr('data-revision', delta.revision).data('revision', delta.revision);
+        span.attr('class', 'actiontask ' + delta.status);
+        title.text(title.text().replace(/^(\[[^\]]*\])\[[^\]]*\]/, '$1[' + delta.status + ']'));
+        notes.children('li:has(pre)').remove();
+        $.each(delta.notes, function(i, note) {
+            notes.append($('<li>').addClass(note[1]).attr('data-note_id', note[0]).text(note[2]));
+        });
+        if (delta.traceback) {
+            notes.append($('<li class="error">').append($('<pre>').text(delta.traceback)));
+        }
+    }
+
+    // Apply the changes of a task to its changelist status columns.
+    function patchTaskStatus(task_id, delta) {
+        var column = $('span.task-status[data-task_id="' + task_id + '"]');
+        column.attr('class', 'task-status ' + delta.status_tag);
+        column.attr('data-revision', delta.revision).data('revision', delta.revision);
+        column.children('span.status').text('[' + delta.status + ']');
+    }
+
+    function getCsrfToken() {
+        var token = $('input[name=csrfmiddlewaretoken]').val();
+        if (!token) {
+            var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]*)/);
+            token = match ? decodeURIComponent(match[1]) : '';
+        }
+        return token;
     }
 
     function ajaxFailure(response) {
         console.log(error_msg + response.status + ':' + response.statusText);
     }
 
+    // Schedule the next run using the delay recommended by the server. The
+    // backoff grows with each idle run.
+    function schedule(server_delay, idle) {
+        if (server_delay) {
+            delay = server_delay;
+        }
+        if (idle) {
+            backoff = Math.min(backoff * 2, max_backoff);
+        }
+        window.clearTimeout(timer);
+        timer = window.setTimeout(run, Math.min(delay * backoff, max_delay) * 1000);
+    }
+
+    // Messages updated within a stream are not stored by the server. Fetch
+    // them once more with their previous revisions to get them stored.
+    function storeTaskMessages(msgs) {
+        var url = updateurl + "msgs=" + encodeURIComponent(JSON.stringify(msgs));
+        $.get(url)
+            .done(function(response) {
+                updateTaskMessages(response.messages);
+            })
+            .fail(ajaxFailure);
+    }
+
+    // Receive updated messages as server-sent events. The server closes the
+    // stream with a close event passing the recommended delay. Then we start
+    // over with the current state of the messages.
+    function streamTaskMessages(url, msgs) {
+        var changed = {};
+        source = new EventSource(url);
+        source.onmessage = function(event) {
+            var updated = JSON.parse(event.data);
+            $.each(msgs, function(task_id, msg) {
+                if (msg.msg_id in updated) {
+                    changed[task_id] = msg;
+                }
+            });
+            updateTaskMessages(updated);
+        };
+        source.addEventListener('close', function(event) {
+            var data = JSON.parse(event.data);
+            source.close();
+            source = null;
+            if (!data.stored && !$.isEmptyObject(changed)) {
+                storeTaskMessages(changed);
+            }
+            // A stream waits for updates itself. So a quiet stream does not
+            // delay the next one.
+            backoff = 1;
+            schedule(data.delay, false);
+        });
+        source.onerror = function() {
+            source.close();
+            source = null;
+            console.log(error_msg + 'event stream failed');
+            schedule(null, true);
+        };
+    }
+
+    // Fallback for browsers without EventSource support and pages with too
+    // many messages to pass them as url parameters. Only the changes of the
+    // tasks are returned and patched into their messages.
+    function pollTaskMessages(tasks) {
+        $.ajax({
+            url: pollurl,
+            type: 'POST',
+            contentType: 'application/json',
+            dataType: 'json',
+            data: JSON.stringify({tasks: tasks}),
+            headers: {'X-CSRFToken': getCsrfToken()},
+        })
+            .done(function(response) {
+                var changed = !$.isEmptyObject(response.tasks);
+                $.each(response.tasks, patchTaskMessage);
+                $.each(response.tasks, patchTaskStatus);
+                if (changed) {
+                    backoff = 1;
+                }
+                schedule(response.delay, !changed);
+            })
+            .fail(function(response) {
+                ajaxFailure(response);
+                schedule(null, true);
+            });
+    }
+
     function run() {
+        // Do not poll for hidden pages. We start over when the page is shown.
+        if (document.hidden) {
+            return;
+        }
         var msgs = {};
+        var tasks = [];
         $('tr.item-message div.task-waiting,tr.item-message div.task-running').each(
             function(i, e) {
                 var msg = new TaskMessage(e);
+                var note_ids = $(e).find('li[data-note_id]').map(function() {
+                    return $(this).data('note_id');
+                }).get();
                 msgs[$(e).data('task_id')] = {
                     msg_id: msg.msg_id,
-                    checksum: msg.checksum,
+                    revision: msg.revision,
                 }
+                tasks.push([$(e).data('task_id'), msg.revision, Math.max(0, ...note_ids)]);
             }
         );
-        if (!$.isEmptyObject(msgs)) {
+        // Status columns of tasks without a message could only be updated by
+        // batch polling.
+        var columns = false;
+        $('span.task-status.task-waiting,span.task-status.task-running').each(
+            function(i, e) {
+                var task_id = $(e).data('task_id');
+                if (!(task_id in msgs)) {
+                    msgs[task_id] = null;
+                    columns = true;
+                    tasks.push([task_id, $(e).data('revision'), 0]);
+                }
+            }
+        );
+        if (tasks.length) {
             var url = baseurl + "msgs=" + encodeURIComponent(JSON.stringify(msgs));
-            console.log(url);
-            window.setTimeout(getTaskMessages, interval, url);
+            if (!columns && window.EventSource && url.length <= max_url_length) {
+                streamTaskMessages(url, msgs);
+            } else {
+                pollTaskMessages(tasks);
+            }
         }
     }
 
+    $(document).on('visibilitychange', function() {
+        window.clearTimeout(timer);
+        if (document.hidden) {
+            if (source) {
+                source.close();
+                source = null;
+            }
+        } else if (!source) {
+            backoff = 1;
+            run();
+        }
+    });
+
     $(document).ready(run);
 })($);
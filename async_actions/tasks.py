@@ -1,12 +1,40 @@
+import random
+import time
+from collections import defaultdict
 from item_messages.constants import INFO
+from billiard.einfo import ExceptionInfo
 from celery import Task
 from celery import shared_task
+from celery import states
+from celery.exceptions import Retry
 from celery.utils.time import get_exponential_backoff_interval
+from django.utils import timezone
 from .models import ActionTaskState
-from .models import Lock
+from .models import ActionTaskNote
+from .models import LockWaiter
+from .events import touch_task
+from .locks import acquire_slot
+from .locks import get_lock_backend
+from .locks import wake_waiters
+from .metrics import timed
+from .retention import purge_task_states
+from .settings import ASYNC_ACTIONS_CONCURRENCY_RETRY_DELAY
+from .settings import ASYNC_ACTIONS_CONCURRENCY_TIMEOUT
+from .settings import ASYNC_ACTIONS_LOCK_TIMEOUT
+from .settings import ASYNC_ACTIONS_LOCK_WAIT_QUEUE
+from .settings import ASYNC_ACTIONS_NOTE_BUFFER_SIZE
+from .settings import ASYNC_ACTIONS_NOTE_BUFFER_TIME
 from .exceptions import OccupiedLockException
 
 
+#: Keys of the counts returned by :meth:`.ActionTask.run_batch` by item state.
+BATCH_COUNTS = {
+    states.SUCCESS: 'succeeded',
+    states.FAILURE: 'failed',
+    states.RETRY: 'retried',
+}
+
+
 class ActionTask(Task):
     """
     _summary_
@@ -26,44 +54,347 @@ class ActionTask(Task):
     locked_retry_backoff_max = 300
     locked_retry_jitter = True
 
+    #: Lease time of locks in seconds. Use :meth:`.heartbeat` to extend the
+    #: lease of long running tasks. None means locks never expire.
+    lock_timeout = ASYNC_ACTIONS_LOCK_TIMEOUT
+
+    #: Wait for occupied locks in a queue instead of retrying. Waiting tasks
+    #: are re-sent as soon as the lock is released.
+    lock_wait_queue = ASYNC_ACTIONS_LOCK_WAIT_QUEUE
+
+    #: Buffer notes and write them in bulk every note_buffer_size notes or
+    #: after note_buffer_time milliseconds. Disabled if note_buffer_size is 0.
+    note_buffer_size = ASYNC_ACTIONS_NOTE_BUFFER_SIZE
+    note_buffer_time = ASYNC_ACTIONS_NOTE_BUFFER_TIME
+
+    #: Maximal number of runs of the task at the same time across all
+    #: workers. Could be overwritten per signature by a max_concurrency
+    #: header. None means no limit.
+    max_concurrency = None
+
+    #: Lease time of a concurrency slot in seconds. Use :meth:`.heartbeat`
+    #: to extend the lease of long running tasks.
+    concurrency_timeout = ASYNC_ACTIONS_CONCURRENCY_TIMEOUT
+
+    #: Tasks over the concurrency limit are deferred for about that many
+    #: seconds. The jitter spreads deferred tasks between 0.5 and 1.5 times
+    #: the delay.
+    concurrency_retry_delay = ASYNC_ACTIONS_CONCURRENCY_RETRY_DELAY
+    concurrency_retry_jitter = True
+
+    #: Related objects fetched together with the object the task runs with.
+    #: These are passed to select_related and prefetch_related.
+    obj_select_related = tuple()
+    obj_prefetch_related = tuple()
+
     #: Be sure there are defaults for some extra task attributes we use.
     _state = None
+    _obj = None
     _lock_ids = None
+    _batch = None
+    _batch_item = None
+    _slot_id = None
+
+    @property
+    def lock_owner(self):
+        """
+        Owner of the locks acquired by this task. The lock tasks of a chain
+        using :attr:`~.processor.Processor.OUTER_LOCK` share the owner passed
+        in by a lock_owner header.
+        """
+        headers = self.request.headers or {}
+        if headers.get('lock_owner'):
+            return headers['lock_owner']
+        return f'{self.request.id}@{self.request.hostname}'
+
+    def _get_locks(self, *lock_ids):
+        return get_lock_backend().get_locks(
+            *lock_ids,
+            owner=self.lock_owner,
+            timeout=self.lock_timeout,
+        )
+
+    def wait_for_locks(self, exc, *lock_ids):
+        """
+        Register the task as waiter on the occupied lock and park it. The task
+        will be re-sent when the lock is released. Parking does not count as
+        retry.
+
+        :param :class:`~.exceptions.OccupiedLockException` exc: lock exception
+        :raise :class:`~celery.exceptions.Retry`: to park the task
+        :return list: the locks if they were released in the meantime
+        """
+        waiter = LockWaiter.objects.add_waiter(
+            exc.args[0], self.request.id, self.signature_from_request())
+
+        # The lock might have been released before we were registered as
+        # waiter. So we try it once again.
+        try:
+            locks = self._get_locks(*lock_ids)
+        except OccupiedLockException:
+            raise Retry(exc=exc)
+
+        # If our waiter is already gone the task was re-sent in the meantime.
+        # In this case we leave the work to the re-sent task.
+        if LockWaiter.objects.remove_waiter(waiter):
+            return locks
+        else:
+            get_lock_backend().release_locks(*lock_ids, owner=self.lock_owner)
+            raise Retry(exc=exc)
+
+    def _get_locked_countdown(self, retries):
+        """
+        Get the countdown for a retry caused by occupied locks.
+
+        :param int retries: number of retries so far
+        :return int: countdown in seconds
+        """
+        if self.locked_retry_backoff:
+            return get_exponential_backoff_interval(
+                factor=int(max(1,0, self.locked_retry_backoff)),
+                retries=retries,
+                maximum=self.locked_retry_backoff_max,
+                full_jitter=self.locked_retry_jitter,
+            )
+        else:
+            return self.locked_retry_delay
 
     def get_locks(self, *lock_ids):
         try:
-            return Lock.objects.get_locks(*lock_ids)
+            return self._get_locks(*lock_ids)
         except OccupiedLockException as exc:
-            if self.locked_retry_backoff:
-                countdown = get_exponential_backoff_interval(
-                    factor=int(max(1,0, self.locked_retry_backoff)),
-                    retries=self.request.retries,
-                    maximum=self.locked_retry_backoff_max,
-                    full_jitter=self.locked_retry_jitter,
-                )
-            else:
-                countdown = self.locked_retry_delay
+            if self.lock_wait_queue:
+                return self.wait_for_locks(exc, *lock_ids)
             self.retry(
                 exc=exc,
-                countdown=countdown,
+                countdown=self._get_locked_countdown(self.request.retries),
                 max_retries=self.locked_max_retries,
             )
 
+    def defer(self, countdown):
+        """
+        Re-send the task with the same id, headers and number of retries and
+        stop the current run. Unlike :meth:`~celery.app.task.Task.retry` this
+        does not count as retry.
+
+        :param int countdown: countdown in seconds
+        :raise :class:`~celery.exceptions.Retry`: to stop the current run
+        """
+        self.signature_from_request().apply_async(countdown=countdown)
+        raise Retry(f'Deferred for {countdown} seconds.', when=countdown)
+
+    def signature_from_request(self, request=None, args=None, kwargs=None, queue=None,
+                               **extra_options):
+        """
+        Within a batch the signature is built for the current item only. It
+        gets the task id and the lock ids of the item and no batch header. So
+        retrying or deferring an item does not re-send the whole batch.
+        """
+        sig = super().signature_from_request(request, args, kwargs, queue, **extra_options)
+        if self._batch_item is not None:
+            task_id, lock_ids = self._batch_item
+            headers = sig.options.get('headers') or {}
+            headers = {k: v for k, v in headers.items() if k not in ('batch', 'batch_retries')}
+            headers['task_state'] = True
+            if lock_ids:
+                headers['lock_ids'] = lock_ids
+            sig.set(task_id=task_id, headers=headers)
+        return sig
+
+    def _get_max_concurrency(self):
+        try:
+            return self.request.headers['max_concurrency']
+        except (TypeError, KeyError):
+            return self.max_concurrency
+
+    def get_slot(self):
+        """
+        Get a slot of the task's counting semaphore or defer the task if all
+        :attr:`.max_concurrency` slots are occupied.
+        """
+        max_concurrency = self._get_max_concurrency()
+        if not max_concurrency:
+            return
+        with timed(ActionTask, 'task.slot', task=self.name):
+            self._slot_id = acquire_slot(
+                self.name, max_concurrency,
+                owner=self.lock_owner,
+                timeout=self.concurrency_timeout,
+            )
+        if self._slot_id is None:
+            countdown = self.concurrency_retry_delay
+            if self.concurrency_retry_jitter:
+                countdown = round(countdown * random.uniform(0.5, 1.5), 3)
+            self.defer(countdown)
+
+    def release_slot(self):
+        """
+        Release the concurrency slot of the task.
+        """
+        if self._slot_id:
+            get_lock_backend().release_locks(self._slot_id, owner=self.lock_owner)
+            self._slot_id = None
+
     def before_start(self, task_id, args, kwargs):
         """
         _summary_
         """
         # Since Tasks instances might be reused within one worker process we
-        # explicitly set the state to None.
+        # explicitly reset the state and the object.
         self._state = None
+        self._obj = None
+        self._slot_id = None
+        self._lock_ids = None
 
-        # Get locks if some lock ids were passed in as header.
+        # Wait for a slot if the number of concurrent runs is limited.
+        self.get_slot()
+
+        # A batch of objects passed in as header is run by run_batch, which
+        # gets the locks of each object itself.
         try:
-            self._lock_ids = self.request.headers['lock_ids']
+            self._batch = self.request.headers['batch']
         except (TypeError, KeyError):
-            self._lock_ids = None
+            self._batch = None
+
+        # Get locks if some lock ids were passed in as header. The lock ids
+        # are kept for the release once the locks were acquired.
+        try:
+            lock_ids = self.request.headers['lock_ids']
+        except (TypeError, KeyError):
+            pass
+        else:
+            with timed(ActionTask, 'task.lock', task=self.name):
+                self.get_locks(*lock_ids)
+            self._lock_ids = lock_ids
+
+    def __call__(self, *args, **kwargs):
+        if self._batch is not None:
+            batch, self._batch = self._batch, None
+            return self.run_batch(batch, *args, **kwargs)
+        with timed(ActionTask, 'task.body', task=self.name):
+            return super().__call__(*args, **kwargs)
+
+    def _run_batch_item(self, task_id, lock_ids, args, kwargs):
+        """
+        Run the task body for a single item of a batch and store its outcome
+        as result of the item's task state. An item retried by its body is
+        re-sent on its own, see :meth:`.signature_from_request`.
+
+        :return str: the state of the item
+        """
+        if self.track_started:
+            self.backend.store_result(
+                task_id, dict(hostname=self.request.hostname), states.STARTED,
+                request=self.request)
+        self._batch_item = (task_id, lock_ids)
+        try:
+            with timed(ActionTask, 'task.body', task=self.name):
+                retval = self.run(*args, **kwargs)
+        except Retry as exc:
+            self.backend.mark_as_retry(task_id, exc.exc or exc, request=self.request)
+            return states.RETRY
+        except Exception as exc:
+            einfo = ExceptionInfo()
+            self.backend.mark_as_failure(
+                task_id, exc, einfo.traceback, request=self.request, call_errbacks=False)
+            return states.FAILURE
         else:
-            self.get_locks(*self._lock_ids)
+            self.backend.mark_as_done(task_id, retval, request=self.request)
+            return states.SUCCESS
+        finally:
+            self._batch_item = None
+
+    def _defer_batch(self, batch, exceptions, args, kwargs):
+        """
+        Re-send the items of a batch whose locks were occupied with the other
+        headers of the batch, e.g. max_concurrency. Once the
+        :attr:`.locked_max_retries` are exceeded the items fail instead.
+        """
+        retries = self.request.headers.get('batch_retries', 0)
+        if self.locked_max_retries is not None and retries >= self.locked_max_retries:
+            for (task_id, lock_ids), exc in zip(batch, exceptions):
+                self.backend.mark_as_failure(
+                    task_id, exc, request=self.request, call_errbacks=False)
+        else:
+            self.apply_async(
+                args, kwargs,
+                headers={**self.request.headers, 'batch': batch, 'batch_retries': retries + 1},
+                countdown=self._get_locked_countdown(retries),
+            )
+
+    def _get_batch_objs(self, task_states):
+        """
+        Fetch the objects of task states with a single query per model.
+
+        :param list task_states: :class:`~.models.ActionTaskState` instances
+        :return dict: objects by content type id and object id
+        """
+        obj_ids = defaultdict(list)
+        for task_state in task_states:
+            obj_ids[task_state.ctype].append(task_state.obj_id)
+        objs = dict()
+        for ctype, ids in obj_ids.items():
+            for obj in self._get_obj_queryset(ctype).filter(pk__in=ids):
+                objs[(ctype.pk, obj.pk)] = obj
+        return objs
+
+    def run_batch(self, batch, *args, **kwargs):
+        r"""
+        Run the task for a batch of objects passed in as batch header. Each
+        item of the batch is a pair of the task id of an
+        :class:`~.models.ActionTaskState` and the lock ids of its object. The
+        task body runs once per item with :attr:`.state` and :attr:`.obj` set
+        accordingly and its outcome is stored as result of the item's task
+        state. So each object gets its own status and notes.
+
+        Items whose locks are occupied are re-sent as a new batch. This does
+        not count as retry of the other items. Items retried by the task body
+        are re-sent on their own.
+
+        :param list batch: pairs of task ids and lock ids
+        :param list \*args: arguments passed to the task body
+        :param dict \*\*kwargs: keyword arguments passed to the task body
+        :return dict: number of succeeded, failed, retried and deferred items
+        """
+        with timed(ActionTask, 'task.state', task=self.name):
+            queryset = ActionTaskState.objects.select_related('ctype')
+            task_states = queryset.in_bulk([i[0] for i in batch], field_name='task_id')
+        with timed(ActionTask, 'task.obj', task=self.name):
+            objs = self._get_batch_objs(task_states.values())
+
+        counts = dict(succeeded=0, failed=0, retried=0, deferred=0)
+        deferred = list()
+        exceptions = list()
+        for task_id, lock_ids in batch:
+            if task_id not in task_states:
+                continue
+            self._state = task_states[task_id]
+            self._obj = objs.get((self._state.ctype_id, self._state.obj_id))
+            if self._obj is not None:
+                self._state.obj = self._obj
+            self._lock_ids = None
+            if lock_ids:
+                try:
+                    with timed(ActionTask, 'task.lock', task=self.name):
+                        self._get_locks(*lock_ids)
+                except OccupiedLockException as exc:
+                    deferred.append([task_id, lock_ids])
+                    exceptions.append(exc)
+                    continue
+                self._lock_ids = lock_ids
+            try:
+                state = self._run_batch_item(task_id, lock_ids, args, kwargs)
+            finally:
+                self._cleanup()
+            counts[BATCH_COUNTS[state]] += 1
+
+        self._state = None
+        self._obj = None
+        self._lock_ids = None
+        if deferred:
+            self._defer_batch(deferred, exceptions, args, kwargs)
+            counts['deferred'] = len(deferred)
+        return counts
 
     def run_with(self, state):
         """
@@ -77,11 +408,62 @@ class ActionTask(Task):
         :return :class:`~.ActionTask`: the task itself
         """
         self._state = state
+        self._obj = None
+        self._batch = None
         return self
 
-    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+    def heartbeat(self):
+        """
+        Extend the lease of the locks and the concurrency slot held by the
+        task and write buffered notes older than :attr:`.note_buffer_time`.
+        Long running tasks should call this method regularly within
+        :attr:`.lock_timeout` and :attr:`.concurrency_timeout`. Otherwise
+        their buffered notes are not written before the next note is added.
+        """
+        if self._note_buffer_expired():
+            self.flush_notes()
         if self._lock_ids:
-            Lock.objects.release_locks(*self._lock_ids)
+            get_lock_backend().extend_locks(
+                *self._lock_ids,
+                owner=self.lock_owner,
+                timeout=self.lock_timeout,
+            )
+        if self._slot_id:
+            get_lock_backend().extend_locks(
+                self._slot_id,
+                owner=self.lock_owner,
+                timeout=self.concurrency_timeout,
+            )
+
+    def on_retry(self, exc, task_id, args, kwargs, einfo):
+        # The after_return handler is not called for retries. But the notes
+        # must be written and the locks and the slot must be released. The
+        # retried task would be locked out by its own locks otherwise. If the
+        # task retries for occupied locks it holds none.
+        try:
+            self._cleanup()
+        finally:
+            self._lock_ids = None
+            self.release_slot()
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        try:
+            self._cleanup()
+        finally:
+            self.release_slot()
+
+    def _cleanup(self):
+        """
+        Flush the notes and release the locks of the task.
+        """
+        try:
+            with timed(ActionTask, 'task.flush_notes', task=self.name):
+                self.flush_notes()
+        finally:
+            if self._lock_ids:
+                with timed(ActionTask, 'task.release', task=self.name):
+                    get_lock_backend().release_locks(*self._lock_ids, owner=self.lock_owner)
+                    wake_waiters(*self._lock_ids)
 
     @property
     def state(self):
@@ -89,16 +471,34 @@ class ActionTask(Task):
         _summary_
         """
         if not self._state:
-            # TODO: Select-related the state object.
-            self._state = ActionTaskState.objects.get(task_id=self.request.id)
+            with timed(ActionTask, 'task.state', task=self.name):
+                queryset = ActionTaskState.objects.select_related('ctype')
+                self._state = queryset.get(task_id=self.request.id)
         return self._state
 
+    def _get_obj_queryset(self, ctype):
+        queryset = ctype.model_class()._base_manager.all()
+        if self.obj_select_related:
+            queryset = queryset.select_related(*self.obj_select_related)
+        if self.obj_prefetch_related:
+            queryset = queryset.prefetch_related(*self.obj_prefetch_related)
+        return queryset
+
     @property
     def obj(self):
         """
-        _summary_
+        The object the task runs with. It is fetched once per task execution
+        using :attr:`.obj_select_related` and :attr:`.obj_prefetch_related`.
         """
-        return self.state.obj
+        if self._obj is None:
+            state = self.state
+            queryset = self._get_obj_queryset(state.ctype)
+            with timed(ActionTask, 'task.obj', task=self.name):
+                self._obj = queryset.get(pk=state.obj_id)
+
+            # Also populate the cache of the state's generic foreign key.
+            state.obj = self._obj
+        return self._obj
 
     @property
     def notes(self):
@@ -107,11 +507,56 @@ class ActionTask(Task):
         """
         return self.state.notes
 
+    def _get_note_buffer(self):
+        """
+        The buffer lives on the state object. So tasks run with the state of
+        a parent task via :meth:`.run_with` share the buffer of their parent.
+        """
+        state = self.state
+        if not hasattr(state, '_note_buffer'):
+            state._note_buffer = list()
+            state._note_buffer_flushed = None
+        return state._note_buffer
+
+    def _note_buffer_expired(self):
+        """
+        Check if the last flush of a non-empty note buffer is older than
+        :attr:`.note_buffer_time`.
+        """
+        if self._state is None or not getattr(self._state, '_note_buffer', None):
+            return False
+        flushed = self._state._note_buffer_flushed
+        return flushed is None or (time.monotonic() - flushed) * 1000 >= self.note_buffer_time
+
+    def flush_notes(self):
+        """
+        Write all buffered notes to the database.
+        """
+        if self._state is None or not hasattr(self._state, '_note_buffer'):
+            return
+        if self._state._note_buffer:
+            ActionTaskNote.objects.bulk_create(self._state._note_buffer)
+            ActionTaskState.objects.increment_revision(self._state.pk)
+            touch_task(self._state.task_id)
+        self._state._note_buffer.clear()
+        self._state._note_buffer_flushed = time.monotonic()
+
     def add_note(self, note, level=INFO):
         """
         _summary_
         """
-        self.state.notes.create(note=note, level=level)
+        if not self.note_buffer_size:
+            self.state.notes.create(note=note, level=level)
+            return
+
+        buffer = self._get_note_buffer()
+        buffer.append(ActionTaskNote(
+            action_task=self.state, note=note, level=level, created_time=timezone.now()))
+
+        # Flush the buffer if it is full or if the last flush is too long ago.
+        # The first note is always written immediately.
+        if len(buffer) >= self.note_buffer_size or self._note_buffer_expired():
+            self.flush_notes()
 
 
 @shared_task(bind=True, base=ActionTask)
@@ -120,13 +565,38 @@ def get_locks(self, *lock_ids):
 
 
 @shared_task(base=Task)
-def release_locks(*lock_ids):
-    Lock.objects.release_locks(*lock_ids)
+def release_locks(*lock_ids, owner=None):
+    get_lock_backend().release_locks(*lock_ids, owner=owner)
+    wake_waiters(*lock_ids)
 
 
 @shared_task(base=Task)
-def release_locks_on_error(request, exc, traceback, *lock_ids):
+def release_locks_on_error(request, exc, traceback, *lock_ids, owner=None):
     # Do not release locks if the exception was an occupied lock exception. In
     # this case we have nothing to do here.
     if not isinstance(exc, OccupiedLockException):
-        Lock.objects.release_locks(*lock_ids)
+        get_lock_backend().release_locks(*lock_ids, owner=owner)
+        wake_waiters(*lock_ids)
+
+
+@shared_task(base=Task)
+def release_expired_locks():
+    """
+    Release expired locks of dead workers. Run this task periodically, e.g. by
+    using celery beat. Also wake up tasks waiting for locks whose release was
+    missed.
+    """
+    count = get_lock_backend().release_expired_locks()
+    lock_ids = LockWaiter.objects.values_list('lock_id', flat=True).distinct()
+    wake_waiters(*lock_ids)
+    return count
+
+
+@shared_task(base=Task)
+def purge_expired_task_states():
+    """
+    Purge finished task states by the retention policies of the
+    ASYNC_ACTIONS_RETENTION setting. Run this task periodically, e.g. by using
+    celery beat.
+    """
+    return purge_task_states()
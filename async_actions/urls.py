@@ -13,10 +13,31 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
+import django
 from django.urls import path
-from .views import update_task_messages
+from . import views
+from .settings import ASYNC_ACTIONS_ASGI
+
+
+# Under ASGI the polling views are served without a thread per request and
+# messages are streamed. Sync views answer right away. The async views use
+# the async ORM of django 4.1 and streaming with async iterators requires
+# django 4.2. Older versions fall back to the sync views.
+if ASYNC_ACTIONS_ASGI and django.VERSION >= (4, 1):
+    update_task_messages = views.aupdate_task_messages
+    poll_task_messages = views.apoll_task_messages
+else:
+    update_task_messages = views.update_task_messages
+    poll_task_messages = views.poll_task_messages
+
+if ASYNC_ACTIONS_ASGI and django.VERSION >= (4, 2):
+    stream_task_messages = views.astream_task_messages
+else:
+    stream_task_messages = views.stream_task_messages
 
 
 urlpatterns = [
     path('messages/get/', update_task_messages, name='update_task_messages'),
+    path('messages/stream/', stream_task_messages, name='stream_task_messages'),
+    path('messages/poll/', poll_task_messages, name='poll_task_messages'),
 ]
@@ -1,32 +1,463 @@
+import asyncio
 import json
+import time
+from functools import wraps
+from asgiref.sync import sync_to_async
+from celery import states
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.db.models import prefetch_related_objects
+from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import HttpResponseNotAllowed
 from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.views.decorators.http import require_GET
+from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import permission_required
+from item_messages import get_messages
+from .events import get_task_versions
 from .messages import update_task_message
+from .models import ActionTaskNote
 from .models import ActionTaskState
-from .utils import get_task_message_checksum
+from .polling import get_poll_delay
+from .templatetags.task_message import format_traceback
+from .settings import ASYNC_ACTIONS_STREAM_TIMEOUT
+from .settings import ASYNC_ACTIONS_STREAM_INTERVAL
+from .settings import ASYNC_ACTIONS_POLL_MAX_DELAY
+
+
+#: Seconds after which the database is checked for changes even if no task
+#: change was signaled by the cache.
+RECHECK_INTERVAL = 5
+
+
+def _get_task_rows(task_ids):
+    """
+    Get the fields of task states needed to detect changes and to recommend
+    a poll delay.
+
+    :param list task_ids: ids of the tasks
+    :return queryset: tuples of task id, revision, task name, status and date
+        created
+    """
+    task_states = ActionTaskState.objects.filter(task_id__in=task_ids)
+    return task_states.values_list('task_id', 'revision', 'task_name', 'status', 'date_created')
+
+
+def _get_task_states(task_ids):
+    """
+    Get the task states with their notes to update messages.
+
+    :param list task_ids: ids of the tasks
+    :return queryset: :class:`~.models.ActionTaskState` instances
+    """
+    task_states = ActionTaskState.objects.filter(task_id__in=task_ids)
+    return task_states.prefetch_related('notes')
+
+
+def _check_task_messages(data, rows):
+    """
+    Stop watching tasks that do not exist and get the tasks whose revision
+    changed since their messages were rendered.
+
+    :param dict data: task ids mapped to msg_id and revision
+    :param list rows: tuples as returned by :func:`._get_task_rows`
+    :return list: ids of changed tasks
+    """
+    for task_id in set(data.keys()) - set(r[0] for r in rows):
+        del data[task_id]
+    return [r[0] for r in rows if r[1] != data[r[0]].get('revision')]
+
+
+def _set_task_messages(request, data, task_states):
+    """
+    Update the messages of the given task states. The revisions in data are
+    updated and finished tasks are removed from data.
+
+    :param request: the request
+    :param dict data: task ids mapped to msg_id and revision
+    :param list task_states: changed :class:`~.models.ActionTaskState` instances
+    :return dict: message ids mapped to the html of the updated messages
+    """
+    updated_messages = {}
+    for task_state in task_states:
+        # Set the task message and build the json response list.
+        msg_id = data[task_state.task_id]['msg_id']
+        msg = update_task_message(request, msg_id, task_state)
+        if msg:
+            updated_messages[msg.id] = msg.html
+
+        if task_state.status in states.READY_STATES:
+            del data[task_state.task_id]
+        else:
+            data[task_state.task_id]['revision'] = task_state.revision
+
+    return updated_messages
+
+
+def _update_task_messages(request, data):
+    """
+    Update the messages of all tasks whose revision changed since their
+    messages were rendered. The revisions in data are updated and finished
+    tasks are removed from data.
+
+    :param request: the request
+    :param dict data: task ids mapped to msg_id and revision
+    :return tuple: message ids mapped to the html of the updated messages and
+        the recommended delay in seconds until the next poll
+    """
+    rows = list(_get_task_rows(data.keys()))
+    delay = get_poll_delay([r[2:] for r in rows])
+    task_ids = _check_task_messages(data, rows)
+    if not task_ids:
+        return {}, delay
+    return _set_task_messages(request, data, _get_task_states(task_ids)), delay
+
+
+async def _aupdate_task_messages(request, data):
+    """
+    Async variant of :func:`._update_task_messages` using the async ORM.
+    Cache lookups and the message storage are sync only, so they are run in
+    a thread.
+    """
+    rows = [r async for r in _get_task_rows(data.keys())]
+    delay = await sync_to_async(get_poll_delay)([r[2:] for r in rows])
+    task_ids = _check_task_messages(data, rows)
+    if not task_ids:
+        return {}, delay
+    task_states = [t async for t in _get_task_states(task_ids)]
+    return await sync_to_async(_set_task_messages)(request, data, task_states), delay
+
+
+def _get_task_msgs(request):
+    """
+    Map the ids of all tasks with a message in the storage to their messages.
+
+    :param request: the request
+    :return dict: task ids mapped to messages
+    """
+    msgs = dict()
+    for model_msgs in get_messages(request).values():
+        for obj_msgs in model_msgs.values():
+            for msg in obj_msgs.values():
+                task_id = (msg.extra_data or {}).get('task_id')
+                if task_id:
+                    msgs[task_id] = msg
+    return msgs
+
+
+def _get_new_notes(tasks, task_states):
+    """
+    Get the notes added after the last known note of each task with a single
+    query.
+
+    :param dict tasks: task ids mapped to revision and id of the last known note
+    :param list task_states: :class:`~.models.ActionTaskState` instances
+    :return dict: primary keys of task states mapped to lists of notes
+    """
+    condition = Q()
+    for task_state in task_states:
+        condition |= Q(action_task=task_state.pk, pk__gt=tasks[task_state.task_id][1] or 0)
+    notes = {t.pk: list() for t in task_states}
+    if notes:
+        for note in ActionTaskNote.objects.filter(condition).order_by('pk'):
+            notes[note.action_task_id].append(note)
+    return notes
+
+
+def _set_task_deltas(request, tasks, task_states):
+    """
+    Build the deltas of the given task states. The stored messages are only
+    rendered again if their status or revision is outdated.
+
+    :param request: the request
+    :param dict tasks: task ids mapped to revision and id of the last known note
+    :param list task_states: changed :class:`~.models.ActionTaskState` instances
+    :return dict: task ids mapped to their deltas
+    """
+    deltas = dict()
+    msgs = _get_task_msgs(request)
+
+    # Tasks shown in a status column only have no message.
+    with_msg = [t for t in task_states if t.task_id in msgs]
+    outdated = {
+        t.task_id: t for t in with_msg
+        if (msgs[t.task_id].extra_data.get('revision'), msgs[t.task_id].extra_data.get('status'))
+        != (t.revision, t.status)
+    }
+    prefetch_related_objects(list(outdated.values()), 'notes')
+    notes = _get_new_notes(tasks, with_msg)
+
+    for task_state in task_states:
+        delta = dict(
+            status=task_state.status,
+            status_tag=task_state.status_tag,
+            revision=task_state.revision,
+        )
+        deltas[task_state.task_id] = delta
+        if task_state.task_id not in msgs:
+            continue
+        msg = msgs[task_state.task_id]
+        if task_state.task_id in outdated:
+            msg = update_task_message(request, msg.id, task_state)
+        delta.update(
+            tags=msg.tags,
+            notes=[[n.id, n.level_tag, n.note] for n in notes[task_state.pk]],
+            traceback=format_traceback(task_state.traceback) if task_state.traceback else None,
+        )
+    return deltas
+
+
+def _get_task_deltas(request, tasks):
+    """
+    Get the changes of all tasks whose revision differs from the one known by
+    the client. Instead of the rendered message only the status, the message
+    tags, the new revision, the notes added after the last known note and the
+    traceback are returned. The stored messages are updated as well.
+
+    :param request: the request
+    :param list tasks: lists of task id, revision and id of the last known note
+    :return tuple: task ids mapped to their deltas and the recommended delay
+        in seconds until the next poll
+    """
+    tasks = {t[0]: (t + [None, 0])[1:3] for t in tasks}
+    rows = list(_get_task_rows(tasks.keys()))
+    delay = get_poll_delay([r[2:] for r in rows])
+
+    # See if something has changed since the client got the task.
+    task_ids = [r[0] for r in rows if r[1] != tasks[r[0]][0]]
+    if not task_ids:
+        return {}, delay
+    task_states = ActionTaskState.objects.filter(task_id__in=task_ids)
+    return _set_task_deltas(request, tasks, task_states), delay
+
+
+async def _aget_task_deltas(request, tasks):
+    """
+    Async variant of :func:`._get_task_deltas` using the async ORM.
+    """
+    tasks = {t[0]: (t + [None, 0])[1:3] for t in tasks}
+    rows = [r async for r in _get_task_rows(tasks.keys())]
+    delay = await sync_to_async(get_poll_delay)([r[2:] for r in rows])
+    task_ids = [r[0] for r in rows if r[1] != tasks[r[0]][0]]
+    if not task_ids:
+        return {}, delay
+    task_states = [t async for t in ActionTaskState.objects.filter(task_id__in=task_ids)]
+    return await sync_to_async(_set_task_deltas)(request, tasks, task_states), delay
+
+
+async def _awatch_task_messages(request, data):
+    """
+    Async generator checking for updated messages until all tasks are ready or
+    ASYNC_ACTIONS_STREAM_TIMEOUT is reached. Changes are detected by the task
+    versions in the cache. The database is only queried if a version changed
+    or after RECHECK_INTERVAL seconds. Waiting does not occupy a thread.
+
+    :param request: the request
+    :param dict data: task ids mapped to msg_id and revision
+    :return async generator: tuples of updated messages and recommended poll
+        delay for each database check
+    """
+    deadline = time.monotonic() + ASYNC_ACTIONS_STREAM_TIMEOUT
+    versions = None
+    checked = None
+    while data and time.monotonic() < deadline:
+        current_versions = await sync_to_async(get_task_versions)(list(data.keys()))
+        recheck = checked is None or time.monotonic() - checked >= RECHECK_INTERVAL
+        if recheck or current_versions != versions:
+            versions = current_versions
+            checked = time.monotonic()
+            yield await _aupdate_task_messages(request, data)
+        if data:
+            await asyncio.sleep(ASYNC_ACTIONS_STREAM_INTERVAL)
+
+
+def _format_events(updated_messages, delay, stored):
+    """
+    Format updated messages as server-sent events followed by a close event
+    passing the recommended delay until the client should reconnect and
+    whether the updated messages were stored.
+
+    :param dict updated_messages: message ids mapped to html
+    :param int delay: recommended delay in seconds
+    :param bool stored: whether the updated messages were stored
+    :return str: events
+    """
+    events = f'data: {json.dumps(updated_messages)}\n\n' if updated_messages else ''
+    return events + f'event: close\ndata: {json.dumps(dict(delay=delay, stored=stored))}\n\n'
 
 
 @require_GET
 @permission_required("async_actions.view_actiontaskresult", raise_exception=True)
 def update_task_messages(request):
     """
-    _summary_
+    Return the updated messages and the recommended delay in seconds until
+    the messages should be polled again.
     """
     data = json.loads(request.GET['msgs'])
-    updated_messages = {}
-    task_states = ActionTaskState.objects.filter(task_id__in=data.keys())
+    updated_messages, delay = _update_task_messages(request, data)
+    return JsonResponse(dict(messages=updated_messages, delay=delay))
 
-    for task_state in task_states:
-        msg_id = data[task_state.task_id]['msg_id']
-        checksum = data[task_state.task_id]['checksum']
 
-        # See if something has changed since rendered the message.
-        if get_task_message_checksum(task_state) == checksum:
-            continue
+@require_GET
+@permission_required("async_actions.view_actiontaskresult", raise_exception=True)
+def stream_task_messages(request):
+    """
+    Check the task messages once and return right away. A sync view must not
+    hold a worker while waiting for changes, so the messages are only pushed
+    by :func:`.astream_task_messages` under ASGI. Clients accepting
+    text/event-stream get the updated messages as event followed by a close
+    event passing the recommended delay in seconds until they should
+    reconnect. Other clients get the same data as json. In both cases the
+    updated messages are stored with the response.
+    """
+    data = json.loads(request.GET['msgs'])
+    updated_messages, delay = _update_task_messages(request, data)
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        response = HttpResponse(
+            _format_events(updated_messages, delay, stored=True),
+            content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        return response
+    else:
+        return JsonResponse(dict(messages=updated_messages, delay=delay))
+
+
+def _async_view(methods, perm):
+    """
+    Async aware replacement for the require_http_methods and the
+    permission_required decorators which do not support async views before
+    django 5.0.
+
+    :param list methods: allowed request methods
+    :param str perm: required permission
+    """
+    def decorator(view):
+        @wraps(view)
+        async def inner(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            if not await sync_to_async(lambda: request.user.has_perm(perm))():
+                raise PermissionDenied
+            return await view(request, *args, **kwargs)
+        return inner
+    return decorator
+
+
+@_async_view(['GET'], "async_actions.view_actiontaskresult")
+async def aupdate_task_messages(request):
+    """
+    Async variant of :func:`.update_task_messages`.
+    """
+    data = json.loads(request.GET['msgs'])
+    updated_messages, delay = await _aupdate_task_messages(request, data)
+    return JsonResponse(dict(messages=updated_messages, delay=delay))
+
+
+@_async_view(['GET'], "async_actions.view_actiontaskresult")
+async def astream_task_messages(request):
+    """
+    Async variant of :func:`.stream_task_messages` pushing updated task
+    messages to the client until all tasks are ready or the stream times out.
+    Clients accepting text/event-stream get server-sent events, other clients
+    are served by long polling.
+
+    The session could not be saved from within the stream without
+    overwriting the changes of concurrent requests. So the updated messages
+    are not stored. The close event tells the client to fetch them once more
+    by :func:`.update_task_messages`, which stores them.
+    """
+    data = json.loads(request.GET['msgs'])
+    delay = ASYNC_ACTIONS_POLL_MAX_DELAY
+
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        async def stream():
+            delay = ASYNC_ACTIONS_POLL_MAX_DELAY
+            async for updated_messages, delay in _awatch_task_messages(request, data):
+                if updated_messages:
+                    yield f'data: {json.dumps(updated_messages)}\n\n'
+            yield _format_events({}, delay, stored=False)
+
+        response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    else:
+        # The long polling response is a regular one. So the messages are
+        # stored by the middleware.
+        updated_messages = {}
+        async for updated_messages, delay in _awatch_task_messages(request, data):
+            if updated_messages:
+                break
+        return JsonResponse(dict(messages=updated_messages, delay=delay))
+
+
+def _is_task(task):
+    """
+    Check a task of a batch polling request. The task id must be a string,
+    the optional revision and note id integers or None.
+
+    :param task: item of the list of tasks
+    :return bool: True if the task is well-formed
+    """
+    if not isinstance(task, list) or not 1 <= len(task) <= 3:
+        return False
+    if not isinstance(task[0], str):
+        return False
+    return all(v is None or (isinstance(v, int) and not isinstance(v, bool)) for v in task[1:])
 
-        # Set the task message and build the json response list.
-        msg = update_task_message(request, msg_id, task_state)
-        updated_messages[msg.id] = msg.html
 
-    return JsonResponse(updated_messages)
+def _load_tasks(request):
+    """
+    Load the list of tasks from the json body of a batch polling request.
+
+    :param request: the request
+    :return list: lists of task id, revision and id of the last known note or
+        None if the body is malformed
+    """
+    try:
+        tasks = json.loads(request.body)['tasks']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(tasks, list) or not all(_is_task(t) for t in tasks):
+        return None
+    return tasks
+
+
+@require_POST
+@permission_required("async_actions.view_actiontaskresult", raise_exception=True)
+def poll_task_messages(request):
+    """
+    Batch polling of task messages. Expects a json body with a list of task
+    id, revision and id of the last known note for each task::
+
+        {"tasks": [["<task-id>", 3, 17], ...]}
+
+    Returns the changes of all updated tasks and the recommended delay in
+    seconds until the next poll::
+
+        {"tasks": {"<task-id>": {"status": ..., "status_tag": ..., "revision": ...,
+        "tags": ..., "notes": [[<note-id>, <level-tag>, <note>], ...],
+        "traceback": ...}}, "delay": ...}
+
+    Tags, notes and traceback are only returned for tasks with a message.
+    """
+    tasks = _load_tasks(request)
+    if tasks is None:
+        return HttpResponseBadRequest()
+    deltas, delay = _get_task_deltas(request, tasks)
+    return JsonResponse(dict(tasks=deltas, delay=delay))
+
+
+@_async_view(['POST'], "async_actions.view_actiontaskresult")
+async def apoll_task_messages(request):
+    """
+    Async variant of :func:`.poll_task_messages`.
+    """
+    tasks = _load_tasks(request)
+    if tasks is None:
+        return HttpResponseBadRequest()
+    deltas, delay = await _aget_task_deltas(request, tasks)
+    return JsonResponse(dict(tasks=deltas, delay=delay))
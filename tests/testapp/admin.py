@@ -2,6 +2,7 @@ from django.contrib import admin
 from item_messages.actions import clear_item_messages
 from async_actions.actions import as_action
 from async_actions.admin import ActionTaskModelAdmin
+from async_actions.admin import TaskStatusColumnMixin
 from async_actions.processor import Processor
 from .forms import SomeRuntimeData
 from .forms import MoreRuntimeData
@@ -24,8 +25,8 @@ from .tasks import test_chord_with_failing_group
 
 
 @admin.register(TestModel)
-class TestModelAdmin(ActionTaskModelAdmin):
-    list_display = ['id', 'one', 'two', 'three']
+class TestModelAdmin(TaskStatusColumnMixin, ActionTaskModelAdmin):
+    list_display = ['id', 'one', 'two', 'three', 'task_status']
     actions = [
         as_action(test_task),
         as_action(info_task),
@@ -1,23 +1,41 @@
+import asyncio
+import importlib
+import io
 import json
 import urllib
+from datetime import timedelta
 from unittest.mock import patch
 from unittest.mock import Mock
 import celery
+from asgiref.sync import async_to_sync
 from celery.canvas import group
 from celery.canvas import _chain
 from celery.canvas import Signature
+from celery.exceptions import Retry
 import item_messages
 from item_messages.middleware import ItemMessageMiddleware
+from django_celery_results.models import TaskResult
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import PermissionDenied
+from django.core.exceptions import ImproperlyConfigured
 from django.urls import reverse
 from django.http import HttpResponse
 from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import caches
+from django.utils import timezone
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.test import TestCase
 from django.test import RequestFactory
 from testapp.models import TestModel
 from testapp.tasks import test_task
+from testapp.tasks import info_task
+from testapp.tasks import task_with_kwargs
+from testapp.tasks import task_that_fails
 from testapp.tasks import test_chain
 from testapp.tasks import test_group
 from testapp.tasks import test_chord
@@ -27,20 +45,46 @@ from testapp.forms import MoreRuntimeData
 from testapp.celery import app as celery_app
 from async_actions import __version__
 from async_actions.models import Lock
+from async_actions.models import LockWaiter
+from async_actions.locks import AdvisoryLockBackend
+from async_actions.locks import CacheLockBackend
+from async_actions.locks import DatabaseLockBackend
+from async_actions.locks import get_lock_backend
+from async_actions.locks import acquire_slot
+from async_actions.locks import get_slot_ids
 from async_actions.models import ActionTaskState
+from async_actions.models import ActionTaskNote
 from async_actions.tasks import ActionTask
 from async_actions.tasks import get_locks
 from async_actions.tasks import release_locks
 from async_actions.tasks import release_locks_on_error
+from async_actions.tasks import release_expired_locks
+from async_actions.tasks import purge_expired_task_states
+from async_actions.retention import purge_task_states
 from async_actions.exceptions import OccupiedLockException
 from async_actions.messages import build_task_message
 from async_actions.messages import add_task_message
-from async_actions.utils import get_task_message_checksum
+from async_actions.messages import render_task_message
 from async_actions.utils import get_task_name
 from async_actions.utils import get_task_verbose_name
 from async_actions.utils import get_task_description
 from async_actions.views import update_task_messages
+from async_actions.views import stream_task_messages
+from async_actions.views import astream_task_messages
+from async_actions.views import poll_task_messages
+from async_actions.views import aupdate_task_messages
+from async_actions.views import apoll_task_messages
+from async_actions.events import get_task_versions
+from async_actions.polling import get_poll_delay
+from async_actions.settings import ASYNC_ACTIONS_POLL_MIN_DELAY
+from async_actions.settings import ASYNC_ACTIONS_POLL_MAX_DELAY
 from async_actions.processor import Processor
+from async_actions.metrics import stage_timed
+from async_actions.metrics import PrometheusMetricsSink
+from async_actions.metrics import StatsdMetricsSink
+from async_actions.processor import StreamingProcessor
+from async_actions.processor import ConcurrentProcessor
+from async_actions.processor import BatchProcessor
 from async_actions.actions import as_action
 from async_actions.actions import TaskAction
 
@@ -77,13 +121,13 @@ class AsyncActionsTests(TestCase):
         self.messages_middleware = ItemMessageMiddleware(get_response)
 
 
-    def create_task_state(self):
-        obj = TestModel.objects.get(pk=1)
+    def create_task_state(self, pk=1, task_id='dummy-task-id'):
+        obj = TestModel.objects.get(pk=pk)
         content_type = ContentType.objects.get_for_model(type(obj))
         params = dict(
             ctype=content_type,
             obj_id=obj.pk,
-            task_id='dummy-task-id',
+            task_id=task_id,
             task_name='testapp.tasks.dummy_task',
             verbose_name='Dummy task',
             status=celery.states.PENDING
@@ -92,9 +136,9 @@ class AsyncActionsTests(TestCase):
         task_state.save()
         return task_state
 
-    def get_request(self, url, data=None):
+    def get_request(self, url, data=None, **kwargs):
         if data:
-            request = self.factory.post(url, data)
+            request = self.factory.post(url, data, **kwargs)
         else:
             request = self.factory.get(url)
         self.session_middleware.process_request(request)
@@ -135,6 +179,149 @@ class AsyncActionsTests(TestCase):
         with self.assertRaises(Lock.DoesNotExist):
             Lock.objects.get(checksum=lock_ids[1])
 
+        # Locks are acquired and released with a single statement.
+        lock_ids = ['thirdlock', 'firstlock', 'secondlock']
+        with CaptureQueriesContext(connection) as context:
+            locks = Lock.objects.get_locks(*lock_ids)
+        self.assertEqual([l.checksum for l in locks], sorted(lock_ids))
+        inserts = [q for q in context.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        with CaptureQueriesContext(connection) as context:
+            Lock.objects.release_locks(*lock_ids)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertFalse(Lock.objects.filter(checksum__in=lock_ids).exists())
+
+    def test_lock_lease(self):
+        lock_ids = ['firstlock', 'secondlock']
+        locks = Lock.objects.get_locks(*lock_ids, owner='me', timeout=60)
+        self.assertEqual(locks[0].owner, 'me')
+        self.assertGreater(locks[0].expires, timezone.now())
+
+        # Only locks of the owner are extended.
+        expires = locks[0].expires
+        self.assertEqual(Lock.objects.extend_locks(*lock_ids, owner='other', timeout=120), 0)
+        self.assertEqual(Lock.objects.extend_locks(*lock_ids, owner='me', timeout=120), 2)
+        self.assertGreater(Lock.objects.get(checksum='firstlock').expires, expires)
+
+        # Valid locks are still occupied. Expired ones are taken over.
+        with self.assertRaises(OccupiedLockException):
+            Lock.objects.get_locks(*lock_ids, owner='other')
+        Lock.objects.filter(checksum='firstlock').update(expires=timezone.now() - timedelta(seconds=1))
+        with self.assertRaises(OccupiedLockException):
+            Lock.objects.get_locks(*lock_ids, owner='other')
+        Lock.objects.filter(checksum='secondlock').update(expires=timezone.now() - timedelta(seconds=1))
+        Lock.objects.get_locks(*lock_ids, owner='other')
+        self.assertEqual(Lock.objects.filter(owner='other').count(), 2)
+
+        # The expired holder could not release the locks taken over by others.
+        Lock.objects.release_locks(*lock_ids, owner='me')
+        self.assertEqual(Lock.objects.filter(owner='other').count(), 2)
+        backend = CacheLockBackend()
+        backend.get_locks(*lock_ids, owner='other')
+        backend.release_locks(*lock_ids, owner='me')
+        with self.assertRaises(OccupiedLockException):
+            backend.get_locks(*lock_ids, owner='me')
+        backend.release_locks(*lock_ids, owner='other')
+        backend.get_locks(*lock_ids, owner='me')
+        backend.release_locks(*lock_ids)
+
+        # Locks without expiry are never released by the reaper.
+        Lock.objects.get_locks('thirdlock')
+        Lock.objects.filter(checksum__in=lock_ids).update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(release_expired_locks(), 2)
+        self.assertEqual(list(Lock.objects.values_list('checksum', flat=True)), ['thirdlock'])
+
+    def test_lock_wait_queue(self):
+        task_state = self.create_task_state()
+        test_task.request.update(id=task_state.task_id)
+        test_task.lock_wait_queue = True
+        lock_ids = ['lock_one', 'lock_two']
+        Lock.objects.get_locks('lock_two')
+
+        # A task waiting for a lock is parked instead of being retried.
+        try:
+            with self.assertRaises(Retry):
+                test_task.get_locks(*lock_ids)
+        finally:
+            test_task.lock_wait_queue = False
+        waiter = LockWaiter.objects.get()
+        self.assertEqual(waiter.lock_id, 'lock_two')
+        self.assertEqual(waiter.task_id, task_state.task_id)
+        self.assertFalse(Lock.objects.filter(checksum='lock_one').exists())
+
+        # Releasing the lock re-sends the waiting task. The wait queue is
+        # enabled only by the task attribute, not by the setting.
+        with patch.object(Signature, 'apply_async') as apply_async:
+            release_locks('lock_two')
+        apply_async.assert_called_once()
+        self.assertFalse(LockWaiter.objects.exists())
+
+        # Waiters whose release was missed are woken by the periodic sweep.
+        Lock.objects.get_locks('lock_two')
+        test_task.lock_wait_queue = True
+        try:
+            with self.assertRaises(Retry):
+                test_task.get_locks(*lock_ids)
+        finally:
+            test_task.lock_wait_queue = False
+        Lock.objects.all().delete()
+        with patch.object(Signature, 'apply_async') as apply_async:
+            release_expired_locks()
+        apply_async.assert_called_once()
+        self.assertFalse(LockWaiter.objects.exists())
+
+        # If the lock was released while registering the task it continues.
+        test_task.lock_wait_queue = True
+        Lock.objects.get_locks('lock_two')
+        with patch.object(test_task, '_get_locks', side_effect=[OccupiedLockException('lock_two'), ['lock']]):
+            self.assertEqual(test_task.get_locks(*lock_ids), ['lock'])
+        test_task.lock_wait_queue = False
+        self.assertFalse(LockWaiter.objects.exists())
+
+        # A task retried by its body releases its locks and wakes the waiters.
+        Lock.objects.all().delete()
+        test_task.request.update(headers=dict(lock_ids=lock_ids))
+        try:
+            test_task.before_start(task_state.task_id, [], {})
+            LockWaiter.objects.add_waiter('lock_two', 'waiter', test_task.si())
+            with patch.object(Signature, 'apply_async') as apply_async:
+                test_task.on_retry(Retry(), task_state.task_id, [], {}, None)
+            apply_async.assert_called_once()
+            self.assertFalse(Lock.objects.exists())
+
+            # A task parked for occupied locks holds none and wakes no one.
+            Lock.objects.get_locks('lock_two')
+            test_task.lock_wait_queue = True
+            with self.assertRaises(Retry):
+                test_task.before_start(task_state.task_id, [], {})
+            with patch.object(Signature, 'apply_async') as apply_async:
+                test_task.on_retry(Retry(), task_state.task_id, [], {}, None)
+            apply_async.assert_not_called()
+            self.assertTrue(LockWaiter.objects.exists())
+        finally:
+            test_task.lock_wait_queue = False
+            test_task.request.update(headers=None)
+
+    def test_lock_backends(self):
+        # The database backend is used by default.
+        self.assertIsInstance(get_lock_backend(), DatabaseLockBackend)
+
+        # Test the cache backend.
+        backend = CacheLockBackend()
+        backend.get_locks('mylock')
+        with self.assertRaises(OccupiedLockException):
+            backend.get_locks('mylock')
+
+        # Get all locks or none of them.
+        with self.assertRaises(OccupiedLockException):
+            backend.get_locks('firstlock', 'mylock', 'secondlock')
+        backend.get_locks('firstlock', 'secondlock')
+
+        # Release locks.
+        backend.release_locks('mylock', 'firstlock', 'secondlock')
+        backend.get_locks('mylock', 'firstlock', 'secondlock')
+        backend.release_locks('mylock', 'firstlock', 'secondlock')
+
     def test_lock_tasks(self):
         lock_ids = ['lock_one', 'lock_two']
         get_locks(*lock_ids)
@@ -156,6 +343,14 @@ class AsyncActionsTests(TestCase):
         release_locks_on_error(Mock(), Exception(), Mock(), *lock_ids)
         self.assertEqual(Lock.objects.filter(checksum__in=lock_ids).count(), 0)
 
+        # Locks taken over by another owner are kept.
+        Lock.objects.get_locks(*lock_ids, owner='other')
+        release_locks(*lock_ids, owner='stale')
+        release_locks_on_error(Mock(), Exception(), Mock(), *lock_ids, owner='stale')
+        self.assertEqual(Lock.objects.filter(checksum__in=lock_ids).count(), len(lock_ids))
+        release_locks(*lock_ids, owner='other')
+        self.assertEqual(Lock.objects.filter(checksum__in=lock_ids).count(), 0)
+
     def test_build_task_messages(self):
         task_state = self.create_task_state()
         level, msg, tag, data = build_task_message(task_state)
@@ -165,7 +360,7 @@ class AsyncActionsTests(TestCase):
         self.assertTrue(task_state.verbose_name in msg)
         self.assertEqual(tag, 'task-waiting')
         self.assertEqual(data['task_id'], task_state.task_id)
-        self.assertEqual(data['checksum'], get_task_message_checksum(task_state))
+        self.assertEqual(data['revision'], task_state.revision)
 
         task_state.status = celery.states.STARTED
         level, msg, tag, data = build_task_message(task_state)
@@ -182,6 +377,68 @@ class AsyncActionsTests(TestCase):
         self.assertEqual(level, item_messages.ERROR)
         self.assertTrue(task_state.status in msg)
 
+    def test_render_task_message(self):
+        task_state = self.create_task_state()
+        task_state.notes.create(note='foobar', level=item_messages.INFO)
+        task_state.refresh_from_db()
+        msg = render_task_message(task_state)
+        self.assertIn('foobar', msg)
+
+        # Rendering the same revision again is served by the cache.
+        with self.assertNumQueries(0):
+            with patch('async_actions.messages.render_to_string') as render_to_string:
+                self.assertEqual(render_task_message(task_state), msg)
+        render_to_string.assert_not_called()
+
+        # A new revision is rendered again.
+        task_state.notes.create(note='barfoo', level=item_messages.INFO)
+        task_state.refresh_from_db()
+        self.assertIn('barfoo', render_task_message(task_state))
+
+    def test_task_state_revision(self):
+        task_state = self.create_task_state()
+        self.assertEqual(task_state.revision, 0)
+
+        # Status changes by the result backend increment the revision of
+        # tasks marked as having a task state.
+        backend = celery_app.backend
+        request = Mock(headers=dict(task_state=True), spec=['headers'])
+        backend.store_result(task_state.task_id, None, celery.states.STARTED, request=request)
+        task_state.refresh_from_db()
+        self.assertEqual(task_state.revision, 1)
+
+        # Other task results are stored without extra queries.
+        request = Mock(headers=None, spec=['headers'])
+        with CaptureQueriesContext(connection) as context:
+            backend.store_result('other-task-id', None, celery.states.STARTED, request=request)
+        self.assertFalse([q for q in context.captured_queries if 'async_actions' in q['sql']])
+
+        # So does saving the state directly.
+        task_state.save()
+        self.assertEqual(task_state.revision, 2)
+        task_state.refresh_from_db()
+        self.assertEqual(task_state.revision, 2)
+
+        # Saving a stale instance does not overwrite concurrent increments.
+        stale = ActionTaskState.objects.get(pk=task_state.pk)
+        task_state.save()
+        stale.save()
+        task_state.refresh_from_db()
+        self.assertEqual(task_state.revision, 4)
+
+        # The processor marks the signatures that get a task state. Lock
+        # tasks have none.
+        processor = Processor(TestModel.objects.all(), test_chain)
+        tasks = processor.signatures[0].tasks
+        self.assertFalse([t for t in tasks[::3] if 'task_state' in (t.options.get('headers') or {})])
+        for sig in tasks[1:3]:
+            self.assertTrue(sig.options['headers']['task_state'])
+
+        # And adding notes.
+        task_state.notes.create(note='foobar', level=item_messages.INFO)
+        task_state.refresh_from_db()
+        self.assertEqual(task_state.revision, 5)
+
     def test_update_task_messages_view(self):
         # Create task and message to have a msg_id.
         task_state = self.create_task_state()
@@ -193,7 +450,7 @@ class AsyncActionsTests(TestCase):
         params = {
             task_state.task_id: {
                 'msg_id': msg_id,
-                'checksum': get_task_message_checksum(task_state),
+                'revision': task_state.revision,
             }
         }
         url_params = urllib.parse.urlencode(dict(msgs=json.dumps(params)))
@@ -202,7 +459,7 @@ class AsyncActionsTests(TestCase):
         request = self.get_request(url)
         msg_id = add_task_message(request, task_state)
         response = update_task_messages(request)
-        messages = json.loads(response.content.decode())
+        messages = json.loads(response.content.decode())['messages']
 
         # Since we did not alter the task_state no message should have been
         # updated.
@@ -214,28 +471,28 @@ class AsyncActionsTests(TestCase):
         task_state.status = celery.states.STARTED
         task_state.save()
         response = update_task_messages(request)
-        messages = json.loads(response.content.decode())
+        messages = json.loads(response.content.decode())['messages']
         self.assertIn(msg_id, messages)
 
         # Test message with RETRY state.
-        # First update task and call the view with the original checksum.
+        # First update task and call the view with the original revision.
         request = self.get_request(url)
         msg_id = add_task_message(request, task_state)
         task_state.status = celery.states.RETRY
         task_state.traceback = 'Last line of traceback.'
         task_state.save()
         response = update_task_messages(request)
-        messages = json.loads(response.content.decode())
+        messages = json.loads(response.content.decode())['messages']
         self.assertIn(msg_id, messages)
 
-        # Then update the the checksum passed as get params.
-        params[task_state.task_id]['checksum'] = get_task_message_checksum(task_state)
+        # Then update the the revision passed as get params.
+        params[task_state.task_id]['revision'] = task_state.revision
         url_params = urllib.parse.urlencode(dict(msgs=json.dumps(params)))
         url = f'/async_actions/update_task_messages/?{url_params}'
         request = self.get_request(url)
         msg_id = add_task_message(request, task_state)
         response = update_task_messages(request)
-        messages = json.loads(response.content.decode())
+        messages = json.loads(response.content.decode())['messages']
         self.assertDictEqual(messages, {})
 
         # Now Update the traceback and see if the message will be updated by our
@@ -245,9 +502,317 @@ class AsyncActionsTests(TestCase):
         task_state.traceback = 'Another last traceback line.'
         task_state.save()
         response = update_task_messages(request)
-        messages = json.loads(response.content.decode())
+        messages = json.loads(response.content.decode())['messages']
         self.assertIn(msg_id, messages)
 
+    def test_update_task_messages_view_num_queries(self):
+        url = reverse('admin:testapp_testmodel_changelist')
+
+        def poll(count):
+            caches['default'].clear()
+            ActionTaskState.objects.all().delete()
+            request = self.get_request(url)
+            params = dict()
+            for pk in range(1, count + 1):
+                task_state = self.create_task_state(pk, f'task-id-{pk}')
+                task_state.notes.create(note='foobar', level=item_messages.INFO)
+                params[task_state.task_id] = {
+                    'msg_id': add_task_message(request, task_state),
+                    'revision': task_state.revision,
+                }
+            ActionTaskState.objects.update(status=celery.states.STARTED)
+            url_params = urllib.parse.urlencode(dict(msgs=json.dumps(params)))
+            request = self.get_request(f'{url}?{url_params}')
+            for task_state in ActionTaskState.objects.order_by('obj_id'):
+                add_task_message(request, task_state)
+            with CaptureQueriesContext(connection) as context:
+                response = update_task_messages(request)
+            self.assertEqual(len(json.loads(response.content.decode())['messages']), count)
+            return len(context.captured_queries)
+
+        # The number of queries does not depend on the number of tasks.
+        self.assertEqual(poll(2), poll(6))
+
+    @patch('async_actions.views.ASYNC_ACTIONS_STREAM_INTERVAL', 0.01)
+    @patch('async_actions.views.ASYNC_ACTIONS_STREAM_TIMEOUT', 0.2)
+    def test_stream_task_messages_view(self):
+        task_state = self.create_task_state()
+        url = reverse('stream_task_messages')
+        request = self.get_request(url)
+        params = {
+            task_state.task_id: {
+                'msg_id': add_task_message(request, task_state),
+                'revision': task_state.revision,
+            }
+        }
+        url_params = urllib.parse.urlencode(dict(msgs=json.dumps(params)))
+        url = f'{url}?{url_params}'
+
+        # State transitions are signaled by a new task version.
+        versions = get_task_versions([task_state.task_id])
+        task_state.status = celery.states.STARTED
+        task_state.save()
+        self.assertNotEqual(versions, get_task_versions([task_state.task_id]))
+
+        # The sync view returns the updated messages right away.
+        request = self.get_request(url)
+        msg_id = add_task_message(request, task_state)
+        response = stream_task_messages(request)
+        self.assertIn(msg_id, json.loads(response.content.decode())['messages'])
+
+        # Without changes it returns an empty response.
+        params[task_state.task_id]['revision'] = task_state.revision
+        url_params = urllib.parse.urlencode(dict(msgs=json.dumps(params)))
+        url = f'{reverse("stream_task_messages")}?{url_params}'
+        request = self.get_request(url)
+        add_task_message(request, task_state)
+        response = stream_task_messages(request)
+        self.assertDictEqual(json.loads(response.content.decode())['messages'], {})
+
+        # Event stream clients get a single event and a close event. The
+        # messages are stored with the response.
+        task_state.status = celery.states.SUCCESS
+        task_state.save()
+        request = self.get_request(url)
+        request.META['HTTP_ACCEPT'] = 'text/event-stream'
+        msg_id = add_task_message(request, task_state)
+        response = stream_task_messages(request)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertFalse(response.streaming)
+        events = response.content.decode().split('\n\n')
+        self.assertIn(msg_id, json.loads(events[0][len('data: '):]))
+        self.assertTrue(events[1].startswith('event: close'))
+        self.assertTrue(json.loads(events[1].split('data: ')[1])['stored'])
+
+        # Under ASGI server-sent events are streamed until the task is ready
+        # without touching the session.
+        request = self.get_request(url)
+        request.META['HTTP_ACCEPT'] = 'text/event-stream'
+        msg_id = add_task_message(request, task_state)
+
+        async def consume(response):
+            return ''.join([c.decode() async for c in response.streaming_content])
+
+        with patch.object(request.session, 'save') as save:
+            response = async_to_sync(astream_task_messages)(request)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            events = async_to_sync(consume)(response).split('\n\n')
+        save.assert_not_called()
+        self.assertIn(msg_id, json.loads(events[0][len('data: '):]))
+        self.assertTrue(events[1].startswith('event: close'))
+        close = json.loads(events[1].split('data: ')[1])
+        self.assertIn('delay', close)
+        self.assertFalse(close['stored'])
+
+        # Long polling waits for changes and returns on timeout.
+        request = self.get_request(url)
+        add_task_message(request, task_state)
+        params[task_state.task_id]['revision'] = task_state.revision
+        request.GET = request.GET.copy()
+        request.GET['msgs'] = json.dumps(params)
+        response = async_to_sync(astream_task_messages)(request)
+        self.assertDictEqual(json.loads(response.content.decode())['messages'], {})
+
+    def test_poll_task_messages_view(self):
+        task_state = self.create_task_state()
+        note = task_state.notes.create(note='foobar', level=item_messages.INFO)
+        task_state.refresh_from_db()
+        url = reverse('poll_task_messages')
+
+        def poll(*tasks):
+            data = json.dumps(dict(tasks=tasks))
+            request = self.get_request(url, data, content_type='application/json')
+            add_task_message(request, task_state)
+            response = poll_task_messages(request)
+            return json.loads(response.content.decode())
+
+        # Unchanged tasks are not returned.
+        response = poll([task_state.task_id, task_state.revision, note.id])
+        self.assertDictEqual(response['tasks'], {})
+        self.assertIn('delay', response)
+
+        # Only notes added after the last known note are returned.
+        revision = task_state.revision
+        new_note = task_state.notes.create(note='barfoo', level=item_messages.INFO)
+        ActionTaskState.objects.filter(pk=task_state.pk).update(
+            status=celery.states.FAILURE, traceback='Last line of traceback.')
+        response = poll([task_state.task_id, revision, note.id])
+        delta = response['tasks'][task_state.task_id]
+        self.assertEqual(delta['status'], celery.states.FAILURE)
+        self.assertIn('task-ready', delta['tags'])
+        self.assertEqual(delta['revision'], revision + 1)
+        self.assertEqual(delta['notes'], [[new_note.id, 'info', 'barfoo']])
+        self.assertEqual(delta['traceback'], 'Last line of traceback.')
+
+        # Without a last known note all notes are returned.
+        response = poll([task_state.task_id, revision])
+        self.assertEqual(len(response['tasks'][task_state.task_id]['notes']), 2)
+
+        # Unknown tasks are ignored.
+        self.assertDictEqual(poll(['unknown-task-id', 0, 0])['tasks'], {})
+
+        # Stored messages which are up to date are not rendered again.
+        task_state.refresh_from_db()
+        with patch('async_actions.views.update_task_message') as update_task_message:
+            response = poll([task_state.task_id, revision, new_note.id])
+        update_task_message.assert_not_called()
+        delta = response['tasks'][task_state.task_id]
+        self.assertIn('task-ready', delta['tags'])
+        self.assertEqual(delta['notes'], [])
+
+        # Malformed bodies are rejected.
+        malformed = (
+            'no json', json.dumps(dict(foo=[])), json.dumps(dict(tasks='foo')),
+            json.dumps(dict(tasks=[[{}, 1, 0]])), json.dumps(dict(tasks=[['id', 1, 'x']])),
+            json.dumps(dict(tasks=[[]])),
+        )
+        for data in malformed:
+            request = self.get_request(url, data, content_type='application/json')
+            self.assertEqual(poll_task_messages(request).status_code, 400)
+            self.assertEqual(async_to_sync(apoll_task_messages)(request).status_code, 400)
+
+    def test_task_status_column(self):
+        self.client.force_login(self.user)
+        url = reverse('admin:testapp_testmodel_changelist')
+        self.create_task_state(pk=1, task_id='one-a')
+        self.create_task_state(pk=2, task_id='two-a')
+        self.create_task_state(pk=2, task_id='two-b')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertContains(response, 'data-task_id="one-a"')
+        self.assertContains(response, 'data-task_id="two-b"')
+        self.assertNotContains(response, 'data-task_id="two-a"')
+        self.assertContains(response, 'class="task-status task-waiting"', count=2)
+
+        # The number of queries does not depend on the number of rows with
+        # task states.
+        for obj in TestModel.objects.exclude(pk__in=[1, 2]):
+            self.create_task_state(pk=obj.pk, task_id=f'task-{obj.pk}')
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get(url)
+        self.assertContains(response, 'class="task-status task-waiting"', count=TestModel.objects.count())
+
+        # Tasks without a message are polled for their status column.
+        data = json.dumps(dict(tasks=[['one-a', -1, 0]]))
+        request = self.get_request(reverse('poll_task_messages'), data, content_type='application/json')
+        delta = json.loads(poll_task_messages(request).content.decode())['tasks']['one-a']
+        self.assertEqual(delta, dict(status=celery.states.PENDING, status_tag='task-waiting', revision=0))
+
+    def test_async_views(self):
+        task_state = self.create_task_state()
+        task_state.notes.create(note='foobar', level=item_messages.INFO)
+        task_state.refresh_from_db()
+        url = reverse('admin:testapp_testmodel_changelist')
+        request = self.get_request(url)
+        params = {
+            task_state.task_id: {
+                'msg_id': add_task_message(request, task_state),
+                'revision': task_state.revision,
+            }
+        }
+        url_params = urllib.parse.urlencode(dict(msgs=json.dumps(params)))
+        url = f'{reverse("update_task_messages")}?{url_params}'
+
+        def call(view, request):
+            add_task_message(request, task_state)
+            if asyncio.iscoroutinefunction(view):
+                view = async_to_sync(view)
+            return json.loads(view(request).content.decode())
+
+        # Both the sync and the async views return the same updates.
+        task_state.status = celery.states.STARTED
+        task_state.save()
+        response = call(aupdate_task_messages, self.get_request(url))
+        self.assertEqual(len(response['messages']), 1)
+        self.assertDictEqual(
+            response['messages'],
+            call(update_task_messages, self.get_request(url))['messages'])
+
+        data = json.dumps(dict(tasks=[[task_state.task_id, 0, 0]]))
+        request = self.get_request(reverse('poll_task_messages'), data, content_type='application/json')
+        response = call(apoll_task_messages, request)
+        self.assertEqual(response['tasks'][task_state.task_id]['status'], celery.states.STARTED)
+
+        # Allowed methods and permissions are checked.
+        request = self.get_request(url, data, content_type='application/json')
+        self.assertEqual(async_to_sync(aupdate_task_messages)(request).status_code, 405)
+        request = self.get_request(url)
+        request.user = AnonymousUser()
+        with self.assertRaises(PermissionDenied):
+            async_to_sync(aupdate_task_messages)(request)
+
+        # The async views are routed under ASGI for supported django versions
+        # only.
+        from async_actions import urls
+        try:
+            with patch('async_actions.settings.ASYNC_ACTIONS_ASGI', True):
+                with patch('django.VERSION', (4, 2, 0, 'final', 0)):
+                    importlib.reload(urls)
+                    self.assertIs(urls.poll_task_messages, apoll_task_messages)
+                    self.assertIs(urls.stream_task_messages, astream_task_messages)
+                with patch('django.VERSION', (4, 1, 0, 'final', 0)):
+                    importlib.reload(urls)
+                    self.assertIs(urls.poll_task_messages, apoll_task_messages)
+                    self.assertIs(urls.stream_task_messages, stream_task_messages)
+                with patch('django.VERSION', (3, 2, 0, 'final', 0)):
+                    importlib.reload(urls)
+                    self.assertIs(urls.poll_task_messages, poll_task_messages)
+        finally:
+            importlib.reload(urls)
+
+    def test_benchmark_command(self):
+        broker_url = celery_app.conf.CELERY_BROKER_URL
+        always_eager = celery_app.conf.get('CELERY_TASK_ALWAYS_EAGER', False)
+        stdout = io.StringIO()
+        try:
+            call_command(
+                'benchmark', sizes=[2], workflows=['task', 'chain'], tracked=[2],
+                locks=2, repeat=1, stdout=stdout, stderr=io.StringIO())
+        finally:
+            celery_app.conf.CELERY_BROKER_URL = broker_url
+            celery_app.conf.CELERY_TASK_ALWAYS_EAGER = always_eager
+        results = json.loads(stdout.getvalue())
+        self.assertEqual(set(results['dispatch'].keys()), {'task:2', 'chain:2'})
+        self.assertIn('DatabaseLockBackend:1', results['locks'])
+        self.assertIn('seconds', results['polling']['poll_task_messages:2:changed'])
+
+    def test_poll_delay(self):
+        task_state = self.create_task_state()
+        task_state.status = celery.states.STARTED
+        task_state.save()
+        now = timezone.now()
+        task = (task_state.task_name, task_state.status, now)
+
+        # Finished tasks need no polling.
+        finished = (task_state.task_name, celery.states.SUCCESS, now)
+        self.assertEqual(get_poll_delay([finished]), ASYNC_ACTIONS_POLL_MAX_DELAY)
+
+        # Fresh tasks with unknown runtime are polled often, old ones rarely.
+        self.assertEqual(get_poll_delay([task]), ASYNC_ACTIONS_POLL_MIN_DELAY)
+        task = (task_state.task_name, task_state.status, now - timedelta(hours=6))
+        self.assertEqual(get_poll_delay([task]), ASYNC_ACTIONS_POLL_MAX_DELAY)
+
+        # A known runtime lets us poll shortly before the task is expected to
+        # be done. Since runtimes are cached we need to clear the cache.
+        ActionTaskState.objects.filter(pk=task_state.pk).update(
+            status=celery.states.SUCCESS,
+            date_done=task_state.date_created + timedelta(seconds=20))
+        caches['default'].clear()
+        task = (task_state.task_name, task_state.status, now - timedelta(seconds=10))
+        self.assertAlmostEqual(get_poll_delay([task]), 5, places=0)
+
+        # The most urgent task determines the delay.
+        tasks = [(task_state.task_name, task_state.status, now), task]
+        self.assertAlmostEqual(get_poll_delay(tasks), 5, places=0)
+
+        # Only task states done within the runtime window are averaged.
+        self.assertIn(task_state.task_name, ActionTaskState.objects.get_runtimes(task_state.task_name))
+        ActionTaskState.objects.filter(pk=task_state.pk).update(
+            date_created=now - timedelta(days=2, seconds=20), date_done=now - timedelta(days=2))
+        self.assertEqual(ActionTaskState.objects.get_runtimes(task_state.task_name), {})
+        runtimes = ActionTaskState.objects.get_runtimes(task_state.task_name, window=3 * 24 * 3600)
+        self.assertEqual(runtimes[task_state.task_name], timedelta(seconds=20))
+
     def test_processor(self):
         # Initialize a processor.
         queryset = TestModel.objects.all()
@@ -265,6 +830,251 @@ class AsyncActionsTests(TestCase):
             processor.run()
             processor.results
 
+    def test_processor_bulk_create(self):
+        # The number of queries must not depend on the number of objects.
+        queryset = TestModel.objects.all()
+        with CaptureQueriesContext(connection) as context:
+            processor = Processor(queryset, test_chain)
+            processor.signatures
+        inserts = [q for q in context.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(ActionTaskState.objects.count(), len(processor.task_states))
+
+        # Task states are fully usable after being bulk created.
+        task_state = ActionTaskState.objects.get(task_id=processor.task_states[0].task_id)
+        self.assertEqual(task_state, processor.task_states[0])
+        self.assertEqual(task_state.obj, queryset[0])
+        self.assertEqual(task_state.status, celery.states.PENDING)
+        self.assertIsNotNone(task_state.date_created)
+
+        # Insert in batches.
+        ActionTaskState.objects.all().delete()
+        Processor.BATCH_SIZE, batch_size = 5, Processor.BATCH_SIZE
+        try:
+            with CaptureQueriesContext(connection) as context:
+                processor = Processor(queryset, test_task.si())
+                processor.signatures
+        finally:
+            Processor.BATCH_SIZE = batch_size
+        inserts = [q for q in context.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2 * 3)
+        self.assertEqual(ActionTaskState.objects.count(), queryset.count())
+
+    def test_processor_template(self):
+        queryset = TestModel.objects.all()
+        runtime_data = dict(one='foo')
+        sig = task_with_kwargs.s(foo='bar') | info_task.si() | task_with_kwargs.s()
+        processor = Processor(queryset, sig, runtime_data, Processor.OUTER_LOCK)
+        signatures = processor.signatures
+
+        # Runtime data is added to all mutable tasks of a chain.
+        for chain, obj in zip(signatures, queryset):
+            get_locks_sig, first, second, third, release_sig = chain.tasks
+            self.assertEqual(first.kwargs, dict(foo='bar', one='foo'))
+            self.assertEqual(second.kwargs, dict())
+            self.assertEqual(third.kwargs, dict(one='foo'))
+
+            # The lock ids of the object are stamped into the lock tasks.
+            lock_ids = processor._get_lock_ids(obj)
+            self.assertEqual(list(get_locks_sig.args), lock_ids)
+            self.assertEqual(list(release_sig.args), lock_ids)
+            self.assertEqual(list(chain.options['link_error']['args']), lock_ids)
+
+        # Each stamped signature has its own task ids.
+        task_ids = [t.id for c in signatures for t in c.tasks]
+        self.assertEqual(len(task_ids), len(set(task_ids)))
+
+        # The original signature is left untouched.
+        self.assertEqual(sig.tasks[0].kwargs, dict(foo='bar'))
+        self.assertIsNone(sig.tasks[0].id)
+
+        # Lock ids are passed as header with inner locks.
+        processor = Processor(queryset, task_with_kwargs.s(), runtime_data)
+        signature = processor.signatures[0]
+        self.assertEqual(signature.kwargs, runtime_data)
+        self.assertEqual(signature.options['headers']['lock_ids'], processor._get_lock_ids(queryset[0]))
+
+    def test_streaming_processor(self):
+        queryset = TestModel.objects.all()
+        processor = StreamingProcessor(queryset, test_task.si())
+        processor.CHUNK_SIZE = 5
+        processor.MAX_TASK_STATES = 7
+        chunks = [celery.result.GroupResult(celery.uuid(), []) for _ in range(3)]
+        with patch.object(group, 'delay', side_effect=chunks) as delay:
+            result = processor.run()
+
+        # Each chunk is launched as its own group. Like other processors a
+        # saved group result is returned.
+        self.assertEqual(delay.call_count, 3)
+        self.assertIsInstance(result, celery.result.GroupResult)
+        self.assertEqual(result.results, chunks)
+        self.assertEqual(celery.result.GroupResult.restore(result.id).results, chunks)
+        self.assertEqual(ActionTaskState.objects.count(), queryset.count())
+
+        # Only a limited number of task states is kept.
+        self.assertEqual(len(processor.task_states), 7)
+        self.assertEqual(
+            [t.obj_id for t in processor.task_states],
+            list(queryset.values_list('pk', flat=True)[:7]))
+
+    def test_concurrent_processor(self):
+        queryset = TestModel.objects.all()
+        processor = ConcurrentProcessor(queryset, test_task.si())
+        processor.CONCURRENCY = 3
+        published = list()
+
+        def apply_async(sig, producer=None, **options):
+            published.append((sig.id, sig.options.get('group_id'), producer))
+
+        with patch.object(Signature, 'apply_async', apply_async):
+            with patch.object(
+                    processor, '_publish_batch', wraps=processor._publish_batch) as publish_batch:
+                result = processor.run()
+
+        # The tasks are split into one batch per thread.
+        task_ids = [s.id for s in processor.signatures]
+        batches = [c.args[1] for c in publish_batch.call_args_list]
+        self.assertEqual(len(batches), 3)
+        self.assertEqual([s.id for b in batches for s in b], task_ids)
+
+        # All tasks are published once using a producer.
+        self.assertEqual(sorted(p[0] for p in published), sorted(task_ids))
+        self.assertTrue(all(p[2] is not None for p in published))
+
+        # The result covers all tasks of the group.
+        self.assertIsInstance(result, celery.result.GroupResult)
+        self.assertEqual([r.id for r in result.results], task_ids)
+        self.assertTrue(all(p[1] == result.id for p in published))
+
+        # Without concurrency we fall back to a delay call.
+        processor = ConcurrentProcessor(queryset, test_task.si())
+        processor.CONCURRENCY = 1
+        with patch.object(group, 'delay') as delay:
+            processor.run()
+        delay.assert_called_once()
+
+    def test_processor_deduplicate(self):
+        queryset = TestModel.objects.order_by('pk')
+        with patch.object(group, 'delay'):
+            first = Processor(queryset[:3], test_task.si(), deduplicate=True)
+            first.run()
+
+            # Objects with in-flight tasks of the same action are skipped and
+            # their existing task states are reported instead.
+            # The in-flight task states are queried in batches.
+            with patch.object(Processor, 'BATCH_SIZE', 2):
+                second = Processor(queryset[:5], test_task.si(), deduplicate=True)
+                second.run()
+        self.assertEqual(len(second.signatures), 2)
+        self.assertEqual(second.task_states[:3], first.task_states)
+        self.assertEqual(len(second.task_states), 5)
+        self.assertEqual(ActionTaskState.objects.count(), 5)
+        self.assertEqual(len(set(t.fingerprint for t in second.task_states)), 1)
+
+        # Other runtime data makes a different action.
+        processor = Processor(queryset[:1], task_with_kwargs.s(), dict(one='foo'), deduplicate=True)
+        other = Processor(queryset[:1], task_with_kwargs.s(), dict(one='bar'), deduplicate=True)
+        self.assertNotEqual(processor.fingerprint, other.fingerprint)
+        self.assertEqual(
+            processor.fingerprint,
+            Processor(queryset[:1], task_with_kwargs.s(), dict(one='foo')).fingerprint)
+
+        # Finished and timed out task states do not count.
+        ActionTaskState.objects.filter(obj_id=queryset[0].pk).update(status=celery.states.SUCCESS)
+        ActionTaskState.objects.filter(obj_id=queryset[1].pk).update(
+            date_created=timezone.now() - timedelta(seconds=Processor.DEDUPLICATE_TIMEOUT + 1))
+        processor = Processor(queryset[:3], test_task.si(), deduplicate=True)
+        self.assertEqual(len(processor.signatures), 2)
+
+        # Deduplication is opt-in.
+        processor = Processor(queryset[:3], test_task.si())
+        self.assertEqual(len(processor.signatures), 3)
+
+        # Without deduplication no fingerprint is computed, so the runtime
+        # data does not need to be json serializable.
+        processor = Processor(queryset[:1], task_with_kwargs.s(), dict(one=object()))
+        self.assertEqual(len(processor.signatures), 1)
+        self.assertEqual(processor.task_states[0].fingerprint, '')
+
+    def test_batch_processor(self):
+        queryset = TestModel.objects.all()
+        processor = BatchProcessor(queryset, test_task.si(), objects_per_task=4)
+        with patch.object(group, 'delay'):
+            processor.run()
+
+        # Each object gets its own task state. Those are sent in batches.
+        batches = [s.options['headers']['batch'] for s in processor.signatures]
+        self.assertEqual(len(batches), -(-queryset.count() // 4))
+        self.assertTrue(all(len(b) <= 4 for b in batches))
+        task_states = {t.task_id: t for t in processor.task_states}
+        self.assertEqual(len(task_states), queryset.count())
+        self.assertEqual([i[0] for b in batches for i in b], list(task_states))
+        for task_id, lock_ids in batches[0]:
+            self.assertEqual(lock_ids, processor._get_lock_ids(task_states[task_id].obj))
+
+        # Run a batch with an occupied lock.
+        batch = batches[0]
+        get_lock_backend().get_locks(*batch[1][1], owner='someone')
+        with patch.object(ActionTask, 'apply_async') as apply_async:
+            result = test_task.apply(headers=dict(batch=batch, max_concurrency=5))
+        self.assertEqual(result.get(), dict(succeeded=len(batch) - 1, failed=0, retried=0, deferred=1))
+        for task_id, lock_ids in batch:
+            task_state = ActionTaskState.objects.get(task_id=task_id)
+            if task_id == batch[1][0]:
+                self.assertEqual(task_state.status, celery.states.PENDING)
+            else:
+                self.assertEqual(task_state.status, celery.states.SUCCESS)
+                self.assertEqual(task_state.notes.count(), 1)
+        self.assertFalse(Lock.objects.filter(checksum=batch[0][1][0]).exists())
+
+        # The locked object is deferred as a batch of its own. Other headers
+        # like the concurrency limit are kept.
+        apply_async.assert_called_once()
+        self.assertEqual(
+            apply_async.call_args[1]['headers'],
+            dict(batch=[batch[1]], batch_retries=1, max_concurrency=5))
+
+        # Failing objects do not affect the others.
+        processor = BatchProcessor(queryset[:2], task_that_fails.si(), lock_mode=Processor.NO_LOCK)
+        batch = processor.signatures[0].options['headers']['batch']
+        result = task_that_fails.apply(headers=dict(batch=batch))
+        self.assertEqual(result.get(), dict(succeeded=0, failed=2, retried=0, deferred=0))
+        for task_state in ActionTaskState.objects.filter(task_id__in=[i[0] for i in batch]):
+            self.assertEqual(task_state.status, celery.states.FAILURE)
+            self.assertIn('Buuhhhhhh', task_state.traceback)
+
+        # Retrying an item re-sends this item on its own.
+        Lock.objects.all().delete()
+        processor = BatchProcessor(queryset[:2], test_task.si())
+        batch = processor.signatures[0].options['headers']['batch']
+        retries = list()
+
+        def run(*args, **kwargs):
+            if test_task.state.task_id == batch[0][0]:
+                retries.append(test_task.retry(countdown=10, throw=False))
+                raise retries[0]
+
+        with patch.object(test_task, 'run', side_effect=run):
+            result = test_task.apply(headers=dict(batch=batch))
+        self.assertEqual(result.get(), dict(succeeded=1, failed=0, retried=1, deferred=0))
+        sig = retries[0].sig
+        self.assertEqual(sig.id, batch[0][0])
+        self.assertEqual(sig.options['headers'], dict(task_state=True, lock_ids=batch[0][1]))
+        task_states = ActionTaskState.objects.in_bulk([i[0] for i in batch], field_name='task_id')
+        self.assertEqual(task_states[batch[0][0]].status, celery.states.RETRY)
+        self.assertEqual(task_states[batch[1][0]].status, celery.states.SUCCESS)
+
+        # Canvases could not be batched. Actions check this when defined.
+        with self.assertRaises(ValueError):
+            BatchProcessor(queryset, test_chain)
+        with self.assertRaises(ValueError):
+            as_action(test_chain, objects_per_task=5)
+
+        # Actions use the batch processor when objects_per_task is given.
+        action = as_action(test_task, objects_per_task=5)
+        self.assertIs(action._processor_cls, BatchProcessor)
+        self.assertEqual(action._processor_kwargs, dict(objects_per_task=5))
+
     def test_processor_with_outer_lock(self):
         # Initialize a processor with Processor.OUTER_LOCK.
         queryset = TestModel.objects.all()
@@ -280,6 +1090,24 @@ class AsyncActionsTests(TestCase):
         self.assertEqual(sig.tasks[2].type, release_locks)
         self.assertCountEqual(list(task_states), [t for t in processor.task_states])
 
+        # The lock tasks of a chain share an owner of their own.
+        owner = sig.tasks[0].options['headers']['lock_owner']
+        self.assertEqual(sig.tasks[2].kwargs, dict(owner=owner))
+        self.assertEqual(sig.options['link_error']['kwargs'], dict(owner=owner))
+        other = processor.signatures[1].tasks[0].options['headers']['lock_owner']
+        self.assertNotEqual(owner, other)
+        get_locks.request.update(headers=dict(lock_owner=owner))
+        try:
+            self.assertEqual(get_locks.lock_owner, owner)
+        finally:
+            get_locks.request.update(headers=None)
+
+        # Advisory locks could not be released by another worker.
+        with patch('async_actions.processor.get_lock_backend', return_value=AdvisoryLockBackend()):
+            with self.assertRaises(ImproperlyConfigured):
+                Processor(queryset, signature, lock_mode=Processor.OUTER_LOCK)
+            Processor(queryset, signature, lock_mode=Processor.INNER_LOCK)
+
     def test_processor_with_chain_and_inner_lock(self):
         # Initialize a processor with a chain as signature.
         queryset = TestModel.objects.all()
@@ -341,6 +1169,138 @@ class AsyncActionsTests(TestCase):
         self.assertCountEqual([s.type for s in sig.tasks[1].tasks.tasks], [s.type for s in test_chord.tasks])
         self.assertCountEqual(list(task_states), processor.task_states)
 
+    def test_metrics(self):
+        timings = list()
+
+        def receiver(sender, stage, seconds, labels, **kwargs):
+            timings.append((sender, stage, labels))
+
+        stage_timed.connect(receiver)
+        try:
+            # Time the stages of a processor.
+            processor = Processor(TestModel.objects.all(), test_task.si())
+            with patch.object(group, 'delay'):
+                processor.run()
+            stages = [t[1] for t in timings if t[0] is Processor]
+            self.assertEqual(stages, [
+                'processor.fetch', 'processor.clone', 'processor.freeze',
+                'processor.collect_states', 'processor.save_states',
+                'processor.publish', 'processor.save_results',
+            ])
+            self.assertEqual(timings[0][2], dict(action=get_task_name(test_task.si())))
+
+            # And the phases of an action task.
+            timings.clear()
+            task_state = self.create_task_state()
+            test_task.request.update(id=task_state.task_id, headers=dict(lock_ids=['lock_one']))
+            test_task.before_start(task_state.task_id, [], {})
+            test_task()
+            test_task.after_return(celery.states.SUCCESS, None, task_state.task_id, [], {}, None)
+            self.assertEqual([t[1] for t in timings], [
+                'task.lock', 'task.state', 'task.obj', 'task.body',
+                'task.flush_notes', 'task.release',
+            ])
+            self.assertTrue(all(t[0] is ActionTask for t in timings))
+            self.assertEqual(timings[0][2], dict(task=test_task.name))
+        finally:
+            stage_timed.disconnect(receiver)
+            test_task.request.headers = None
+
+        # The sinks.
+        sink = PrometheusMetricsSink()
+        sink.timing('task.body', 0.5, dict(task='my"task'))
+        sink.timing('task.body', 1.5, dict(task='my"task'))
+        metrics = sink.render()
+        self.assertIn('async_actions_stage_seconds_count{stage="task.body",task="my\\"task"} 2', metrics)
+        self.assertIn('async_actions_stage_seconds_sum{stage="task.body",task="my\\"task"} 2.0', metrics)
+        sink = StatsdMetricsSink()
+        metric = sink._format('task.body', 0.5, dict(task='app.tasks.my task'))
+        self.assertEqual(metric, 'async_actions.task.body:500.000|ms|#task:app.tasks.my_task')
+        with patch.object(sink, '_socket') as sock:
+            sink.timing('task.body', 0.5, dict())
+        sock.sendto.assert_called_once()
+
+    def test_latest_states(self):
+        one = self.create_task_state(pk=1, task_id='one-a')
+        self.create_task_state(pk=2, task_id='two-a')
+        two = self.create_task_state(pk=2, task_id='two-b')
+        three = self.create_task_state(pk=1, task_id='one-b')
+        ActionTaskState.objects.filter(pk=three.pk).update(task_name='testapp.tasks.other_task')
+
+        # The latest state per object by a queryset or a list of objects.
+        queryset = TestModel.objects.filter(pk__in=[1, 2, 3])
+        with self.assertNumQueries(1):
+            latest = {s.obj_id: s.task_id for s in ActionTaskState.objects.latest_states(queryset)}
+        self.assertEqual(latest, {1: 'one-b', 2: 'two-b'})
+        latest = ActionTaskState.objects.latest_states(list(queryset))
+        self.assertCountEqual([s.task_id for s in latest], ['one-b', 'two-b'])
+
+        # Filtered by task name or per task name.
+        latest = ActionTaskState.objects.latest_states(queryset, task_names=['testapp.tasks.dummy_task'])
+        self.assertCountEqual([s.task_id for s in latest], [one.task_id, two.task_id])
+        latest = ActionTaskState.objects.latest_states(queryset, per_task_name=True)
+        self.assertCountEqual([s.task_id for s in latest], ['one-a', 'one-b', 'two-b'])
+        self.assertFalse(ActionTaskState.objects.latest_states([]).exists())
+
+        # Sliced querysets are evaluated first.
+        latest = ActionTaskState.objects.latest_states(queryset.order_by('pk')[:1])
+        self.assertEqual([s.task_id for s in latest], ['one-b'])
+
+        # Without DISTINCT ON a subquery is used.
+        with patch.object(connection.features, 'can_distinct_on_fields', False):
+            latest = ActionTaskState.objects.latest_states(queryset, per_task_name=True)
+            self.assertCountEqual([s.task_id for s in latest], ['one-a', 'one-b', 'two-b'])
+
+    def test_retention(self):
+        now = timezone.now()
+        task_states = list()
+        for i in range(6):
+            task_state = self.create_task_state(task_id=f'task-{i}')
+            task_state.notes.create(note='foo')
+            task_states.append(task_state)
+            ActionTaskState.objects.filter(pk=task_state.pk).update(
+                status=celery.states.SUCCESS, date_done=now - timedelta(days=i))
+        ActionTaskState.objects.filter(task_id='task-5').update(task_name='testapp.tasks.other_task')
+        ActionTaskState.objects.filter(task_id='task-4').update(status=celery.states.STARTED)
+
+        # Dry runs only count the states to purge.
+        out = io.StringIO()
+        call_command('purgetaskstates', '--max-age', '1.5', '--dry-run', stdout=out)
+        self.assertIn('*: 3 task states to purge', out.getvalue())
+        self.assertEqual(ActionTaskState.objects.count(), 6)
+
+        # Purge by count in batches. Unfinished states are kept.
+        progress = list()
+        policies = {'testapp.tasks.dummy_task': dict(max_count=2)}
+        counts = purge_task_states(policies, batch_size=1, progress=lambda *a: progress.append(a))
+        self.assertEqual(counts, {'testapp.tasks.dummy_task': 2})
+        self.assertEqual(progress, [('testapp.tasks.dummy_task', 1), ('testapp.tasks.dummy_task', 2)])
+        self.assertCountEqual(
+            ActionTaskState.objects.values_list('task_id', flat=True),
+            ['task-0', 'task-1', 'task-4', 'task-5'])
+        self.assertEqual(ActionTaskNote.objects.count(), 4)
+        self.assertCountEqual(
+            TaskResult.objects.values_list('task_id', flat=True),
+            ['task-0', 'task-1', 'task-4', 'task-5'])
+
+        # Purge the remaining states by the default policy. Tasks with a
+        # policy of their own are left alone. Notes and task results are
+        # deleted as well.
+        with CaptureQueriesContext(connection) as context:
+            purge_task_states({'*': dict(max_count=0), 'testapp.tasks.dummy_task': dict()})
+        self.assertFalse([q for q in context.captured_queries if 'DISTINCT' in q['sql']])
+        self.assertCountEqual(
+            ActionTaskState.objects.values_list('task_id', flat=True),
+            ['task-0', 'task-1', 'task-4'])
+        policies = {'*': dict(max_age=timedelta(hours=1))}
+        with patch('async_actions.retention.ASYNC_ACTIONS_RETENTION', policies):
+            counts = purge_expired_task_states()
+        self.assertEqual(counts, {'*': 1})
+        self.assertCountEqual(
+            ActionTaskState.objects.values_list('task_id', flat=True), ['task-0', 'task-4'])
+        self.assertEqual(ActionTaskNote.objects.count(), 2)
+        self.assertEqual(TaskResult.objects.count(), 2)
+
     def test_action_task(self):
         task_state = self.create_task_state()
         test_task.request.update(id=task_state.task_id)
@@ -355,6 +1315,14 @@ class AsyncActionsTests(TestCase):
         self.assertEqual(test_task.notes.all().count(), 1)
         self.assertEqual(test_task.notes.all()[0].note, 'foobar')
 
+        # State and object are fetched once per task execution.
+        test_task.before_start(task_state.task_id, [], {})
+        with self.assertNumQueries(2):
+            self.assertEqual(test_task.state.ctype, task_state.ctype)
+            self.assertEqual(test_task.obj, task_state.obj)
+            self.assertEqual(test_task.state.obj, task_state.obj)
+            self.assertEqual(test_task.obj, task_state.obj)
+
         # Just call the run_with method.
         self.assertEqual(test_task, test_task.run_with(task_state))
 
@@ -385,11 +1353,163 @@ class AsyncActionsTests(TestCase):
         self.assertIsInstance(test_task.retry.call_args[1]['exc'], OccupiedLockException)
         self.assertEqual(test_task.retry.call_args[1]['countdown'], test_task.locked_retry_delay)
         self.assertEqual(test_task.retry.call_args[1]['max_retries'], test_task.locked_max_retries)
+        del test_task.retry
+
+        # Extend the locks lease.
+        test_task.lock_timeout = 60
+        self.assertEqual(Lock.objects.filter(owner=test_task.lock_owner).count(), 2)
+        test_task.heartbeat()
+        self.assertEqual(Lock.objects.filter(checksum__in=lock_ids, expires__isnull=False).count(), 2)
+        test_task.lock_timeout = None
 
         # Release the locks via after_return method.
         test_task.after_return(Mock(), Mock(), Mock(), Mock(), Mock(), Mock())
         self.assertEqual(Lock.objects.filter(checksum__in=lock_ids).count(), 0)
 
+    def test_concurrency_slots(self):
+        slot_ids = get_slot_ids('some.task', 2)
+        self.assertEqual(slot_ids, get_slot_ids('some.task', 2))
+        self.assertTrue(all(len(i) == 24 for i in slot_ids))
+
+        # A counting semaphore with two slots using different backends.
+        for backend in (DatabaseLockBackend(), CacheLockBackend()):
+            with patch('async_actions.locks.get_lock_backend', return_value=backend):
+                first = acquire_slot('some.task', 2, owner='one')
+                second = acquire_slot('some.task', 2, owner='two')
+                self.assertCountEqual([first, second], slot_ids)
+                self.assertIsNone(acquire_slot('some.task', 2, owner='three'))
+                backend.release_locks(first)
+                self.assertEqual(acquire_slot('some.task', 2, owner='three'), first)
+                backend.release_locks(*slot_ids)
+
+        # Expired slots are taken over.
+        backend = DatabaseLockBackend()
+        backend.get_locks(*slot_ids, owner='dead', timeout=60)
+        Lock.objects.filter(checksum=slot_ids[0]).update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(acquire_slot('some.task', 2, owner='alive'), slot_ids[0])
+        backend.release_locks(*slot_ids)
+
+    def test_action_task_max_concurrency(self):
+        task_state = self.create_task_state()
+        test_task.request.update(id=task_state.task_id, retries=2, headers=None)
+        test_task.max_concurrency = 1
+        slot_id = get_slot_ids(test_task.name, 1)[0]
+        try:
+            # Tasks over the limit are deferred without counting as retry.
+            acquire_slot(test_task.name, 1, owner='someone')
+            with patch.object(Signature, 'apply_async', autospec=True) as apply_async:
+                with self.assertRaises(Retry):
+                    test_task.before_start(task_state.task_id, [], {})
+            sig = apply_async.call_args[0][0]
+            self.assertEqual(sig.id, task_state.task_id)
+            self.assertEqual(sig.options['retries'], 2)
+            self.assertIsNone(test_task._slot_id)
+            get_lock_backend().release_locks(slot_id)
+
+            # Otherwise the task holds a slot until it returns.
+            test_task.before_start(task_state.task_id, [], {})
+            self.assertEqual(test_task._slot_id, slot_id)
+            self.assertEqual(Lock.objects.get(checksum=slot_id).owner, test_task.lock_owner)
+
+            # The heartbeat extends the lease of the slot.
+            Lock.objects.filter(checksum=slot_id).update(expires=timezone.now() + timedelta(seconds=1))
+            test_task.heartbeat()
+            expires = Lock.objects.get(checksum=slot_id).expires
+            self.assertGreater(expires, timezone.now() + timedelta(seconds=test_task.concurrency_timeout - 60))
+            test_task.after_return(celery.states.SUCCESS, None, task_state.task_id, [], {}, None)
+            self.assertFalse(Lock.objects.filter(checksum=slot_id).exists())
+
+            # Or until it retries.
+            test_task.before_start(task_state.task_id, [], {})
+            test_task.on_retry(Retry(), task_state.task_id, [], {}, None)
+            self.assertFalse(Lock.objects.filter(checksum=slot_id).exists())
+
+            # A slot that expired and was taken over is kept.
+            test_task.before_start(task_state.task_id, [], {})
+            Lock.objects.filter(checksum=slot_id).update(expires=timezone.now() - timedelta(seconds=1))
+            self.assertEqual(acquire_slot(test_task.name, 1, owner='someone'), slot_id)
+            test_task.after_return(celery.states.SUCCESS, None, task_state.task_id, [], {}, None)
+            self.assertEqual(Lock.objects.get(checksum=slot_id).owner, 'someone')
+            get_lock_backend().release_locks(slot_id)
+
+            # The limit could be passed in as header.
+            test_task.max_concurrency = None
+            test_task.request.headers = dict(max_concurrency=3)
+            test_task.before_start(task_state.task_id, [], {})
+            self.assertIn(test_task._slot_id, get_slot_ids(test_task.name, 3))
+            test_task.release_slot()
+        finally:
+            test_task.max_concurrency = None
+            test_task.request.headers = None
+            test_task.request.retries = 0
+
+        # Actions pass their limit as header next to the lock ids.
+        sig = test_task.si()
+        action = as_action(sig, max_concurrency=3)
+        self.assertNotIn('headers', sig.options)
+        processor = Processor(TestModel.objects.all(), action._sig)
+        headers = processor.signatures[0].options['headers']
+        self.assertEqual(headers['max_concurrency'], 3)
+        self.assertIn('lock_ids', headers)
+        with self.assertRaises(ValueError):
+            as_action(test_chain, max_concurrency=3)
+
+    def test_action_task_note_buffer(self):
+        task_state = self.create_task_state()
+        test_task.request.update(id=task_state.task_id)
+        test_task.before_start(task_state.task_id, [], {})
+        test_task.note_buffer_size = 3
+        test_task.note_buffer_time = 60000
+        try:
+            # The first note is written immediately. Others are buffered.
+            test_task.add_note('one')
+            test_task.add_note('two')
+            self.assertEqual(task_state.notes.count(), 1)
+
+            # The buffer is flushed when full.
+            with CaptureQueriesContext(connection) as context:
+                test_task.add_note('three')
+            self.assertEqual(len(context.captured_queries), 0)
+            with CaptureQueriesContext(connection) as context:
+                test_task.add_note('four')
+            inserts = [q for q in context.captured_queries if q['sql'].startswith('INSERT')]
+            self.assertEqual(len(inserts), 1)
+            self.assertEqual(task_state.notes.count(), 4)
+
+            # Notes of tasks run with the state of their parent share the
+            # parent's buffer. Remaining notes are flushed on return.
+            test_task.add_note('five')
+            info_task.run_with(test_task.state)
+            info_task.note_buffer_size = 3
+            info_task.add_note('six')
+            self.assertEqual(task_state.notes.count(), 4)
+            test_task.after_return(Mock(), Mock(), Mock(), Mock(), Mock(), Mock())
+            notes = list(task_state.notes.values_list('note', flat=True))
+            self.assertEqual(notes, ['one', 'two', 'three', 'four', 'five', 'six'])
+
+            # Notes keep the time they were added. Buffered notes are also
+            # flushed on retry since after_return is not called then.
+            before = timezone.now()
+            test_task.add_note('seven')
+            test_task.add_note('eight')
+            after = timezone.now()
+            test_task.on_retry(Retry(), task_state.task_id, [], {}, Mock())
+            note = task_state.notes.get(note='eight')
+            self.assertTrue(before <= note.created_time <= after)
+            self.assertEqual(task_state.notes.count(), 8)
+
+            # Long running tasks get their notes written by the heartbeat.
+            test_task.add_note('nine')
+            test_task.add_note('ten')
+            test_task.heartbeat()
+            self.assertEqual(task_state.notes.count(), 8)
+            test_task.state._note_buffer_flushed -= 61
+            test_task.heartbeat()
+            self.assertEqual(task_state.notes.count(), 10)
+        finally:
+            test_task.note_buffer_size = 0
+            info_task.note_buffer_size = 0
+
     def test_get_task_verbose_name(self):
         # Test verbose_name derivation.
         orig_verbose_name = 'foobar'